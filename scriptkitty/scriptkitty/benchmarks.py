@@ -0,0 +1,361 @@
+import sys
+import json
+import time
+import random
+import platform
+import functools
+import tracemalloc
+import dataclasses
+import concurrent.futures
+
+import numpy
+
+from scriptkitty import resonators
+
+# Synthetic program-evolution tasks for timing Decoder and Optimizer. Run
+# `python -m scriptkitty.benchmarks [--workers N] [TASK...]` to print one
+# JSON record per (task, population size, benchmark) as it is measured, so
+# results can be diffed across runs. A task that cannot be built or run
+# prints a record with its error instead and the other tasks carry on.
+
+@dataclasses.dataclass(frozen=True)
+class Task:
+  name: str
+  fitness: list[callable]
+  crossover: list[callable]
+  mutation: list[callable]
+  initial: callable
+  energy: callable
+  target: float
+
+# Components are module-level functions bound with functools.partial so
+# that decoders can be pickled and the executor paths benchmarked.
+
+def _onemax_ones(states):
+  return numpy.asarray(states).sum(axis=1)
+
+def _onemax_at_least(fraction, length, states):
+  return _onemax_ones(states) >= fraction*length
+
+def _onemax_one_point(length, lhs, rhs):
+  index = random.randrange(length)
+  return numpy.concatenate([lhs[:index], rhs[index:]])
+
+def _onemax_uniform(length, lhs, rhs):
+  mask = numpy.random.random(length) < 0.5
+  return numpy.where(mask, lhs, rhs)
+
+def _onemax_flip(rate, length, state):
+  return state ^ (numpy.random.random(length) < rate)
+
+def _onemax_initial(length, size):
+  return list(numpy.random.random((size, length)) < 0.5)
+
+def _onemax_energy(length, states):
+  return -_onemax_ones(states).mean()/length
+
+def onemax(length=64):
+  def at_least(fraction):
+    return resonators.batched(functools.partial(_onemax_at_least, fraction, length))
+
+  def flip(rate):
+    return functools.partial(_onemax_flip, rate, length)
+
+  return Task(
+    'onemax',
+    [at_least(0.0), at_least(0.5), at_least(0.6)],
+    [functools.partial(_onemax_one_point, length), functools.partial(_onemax_uniform, length)],
+    [flip(1/length), flip(4/length)],
+    functools.partial(_onemax_initial, length),
+    functools.partial(_onemax_energy, length),
+    -0.9,
+  )
+
+STRING_ALPHABET = 'abcdefghijklmnopqrstuvwxyz '
+
+def _string_distance(target, state):
+  goal = numpy.frombuffer(target.encode(), dtype=numpy.uint8)
+  return int((numpy.frombuffer(state.encode(), dtype=numpy.uint8) != goal).sum())
+
+def _string_within(fraction, target, state):
+  return _string_distance(target, state) <= fraction*len(target)
+
+def _string_one_point(target, lhs, rhs):
+  index = random.randrange(len(target))
+  return lhs[:index]+rhs[index:]
+
+def _string_point(target, state):
+  index = random.randrange(len(target))
+  return state[:index]+random.choice(STRING_ALPHABET)+state[index+1:]
+
+def _string_swap(target, state):
+  lhs = random.randrange(len(target))
+  rhs = random.randrange(len(target))
+  buf = list(state)
+  buf[lhs], buf[rhs] = buf[rhs], buf[lhs]
+  return ''.join(buf)
+
+def _string_initial(target, size):
+  return [''.join(random.choice(STRING_ALPHABET) for _ in target) for _ in range(size)]
+
+def _string_energy(target, states):
+  return numpy.mean([_string_distance(target, state) for state in states])/len(target)
+
+def string_evolution(target='the quick brown scriptkitty'):
+  def within(fraction):
+    return functools.partial(_string_within, fraction, target)
+
+  return Task(
+    'string_evolution',
+    [within(1.0), within(0.8), within(0.6)],
+    [functools.partial(_string_one_point, target)],
+    [functools.partial(_string_point, target), functools.partial(_string_swap, target)],
+    functools.partial(_string_initial, target),
+    functools.partial(_string_energy, target),
+    0.5,
+  )
+
+# States of symbolic_regression are expression trees of nested tuples. They
+# are printed as Lisp source and evaluated with `lisp.norm`, which is what
+# dominates the cost of real program-evolution runs.
+
+REGRESSION_OPERATORS = ['+', '-', '*']
+
+def _regression_source(expr, x):
+  match expr:
+    case 'x':
+      return str(x)
+    case (operator, lhs, rhs):
+      return f'({operator} {_regression_source(lhs, x)} {_regression_source(rhs, x)})'
+    case _:
+      return str(expr)
+
+def _regression_error(points, expr):
+  from scriptkitty import lisp
+  env   = lisp.initial_environment()
+  xs    = numpy.linspace(-1.0, 1.0, points)
+  ys    = xs*xs+xs+1.0
+  total = 0.0
+  for x, y in zip(xs, ys):
+    value  = lisp.norm(lisp.read(_regression_source(expr, x))[0], env).to_number
+    total += (value-y)**2
+  return total/points
+
+def _regression_size(expr):
+  if isinstance(expr, tuple):
+    return 1+_regression_size(expr[1])+_regression_size(expr[2])
+  return 1
+
+def _regression_leaf():
+  if random.random() < 0.5:
+    return 'x'
+  return float(random.randint(-2, 2))
+
+def _regression_tree(depth):
+  if depth == 0 or random.random() < 0.3:
+    return _regression_leaf()
+  return (random.choice(REGRESSION_OPERATORS), _regression_tree(depth-1), _regression_tree(depth-1))
+
+def _regression_any(expr):
+  return True
+
+def _regression_below(limit, points, expr):
+  return _regression_error(points, expr) <= limit
+
+def _regression_combine(lhs, rhs):
+  if _regression_size(lhs)+_regression_size(rhs) > 31:
+    raise ValueError('symbolic_regression: expression too large')
+  return (random.choice(REGRESSION_OPERATORS), lhs, rhs)
+
+def _regression_graft(lhs, rhs):
+  if not isinstance(lhs, tuple):
+    return rhs
+  return (lhs[0], lhs[1], rhs)
+
+def _regression_replace(expr):
+  if not isinstance(expr, tuple) or random.random() < 0.3:
+    return _regression_tree(2)
+  if random.random() < 0.5:
+    return (expr[0], _regression_replace(expr[1]), expr[2])
+  return (expr[0], expr[1], _regression_replace(expr[2]))
+
+def _regression_constant(expr):
+  if not isinstance(expr, tuple):
+    return _regression_leaf()
+  return (expr[0], _regression_constant(expr[1]), expr[2])
+
+def _regression_initial(count):
+  return [_regression_tree(3) for _ in range(count)]
+
+def _regression_energy(points, states):
+  return min(_regression_error(points, expr) for expr in states)
+
+def symbolic_regression(points=8):
+  # Fails here, rather than in the middle of a run, if `lisp` cannot be
+  # imported.
+  from scriptkitty import lisp
+
+  def below(limit):
+    return functools.partial(_regression_below, limit, points)
+
+  return Task(
+    'symbolic_regression',
+    [_regression_any, below(4.0), below(1.0)],
+    [_regression_combine, _regression_graft],
+    [_regression_replace, _regression_constant],
+    _regression_initial,
+    functools.partial(_regression_energy, points),
+    0.05,
+  )
+
+TASKS = {
+  'onemax': onemax,
+  'string_evolution': string_evolution,
+  'symbolic_regression': symbolic_regression,
+}
+
+def decoder(task, weights, state_capacity, state_bottleneck=2):
+  return resonators.Decoder(
+    task.fitness,
+    task.crossover,
+    task.mutation,
+    weights,
+    state_capacity,
+    state_bottleneck,
+  ).compile()
+
+def num_weights(task, layers):
+  return resonators.Decoder.num_weights_for_components(
+    task.fitness,
+    task.crossover,
+    task.mutation,
+    layers,
+  )
+
+def bench_decoder(task, state_capacity, layers=4, seed=0, executor=None):
+  random.seed(seed)
+  numpy.random.seed(seed)
+  weights = numpy.zeros(num_weights(task, layers))
+  machine = decoder(task, weights, state_capacity)
+  states  = task.initial(state_capacity)
+  start   = time.perf_counter()
+  output  = machine(states, executor=executor, seed=seed)
+  seconds = time.perf_counter()-start
+  tracemalloc.start()
+  machine(states, executor=executor, seed=seed)
+  (_, peak) = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return {
+    'benchmark': 'decoder',
+    'task': task.name,
+    'state_capacity': state_capacity,
+    'layers': layers,
+    'parallel': executor is not None,
+    'seconds': seconds,
+    'seconds_per_layer': seconds/layers,
+    'states_per_second': state_capacity*layers/seconds,
+    'peak_bytes': peak,
+    'energy': float(task.energy(output)),
+  }
+
+class _Recorder:
+  # The `eval` of bench_optimizer: remembers the best energy and when the
+  # task's target was first reached. It is picklable so samples can be
+  # sent to workers, but copies in other processes record into
+  # themselves; with an executor only the threshold measurements, which
+  # always run in this process, are seen.
+  def __init__(self, energy, target, start):
+    self.energy  = energy
+    self.target  = target
+    self.start   = start
+    self.best    = numpy.inf
+    self.reached = None
+
+  def __call__(self, states):
+    energy    = self.energy(states)
+    self.best = min(self.best, energy)
+    if self.reached is None and energy <= self.target:
+      self.reached = time.perf_counter()-self.start
+    return energy
+
+def bench_optimizer(task, state_capacity, num_particles=8, quota=8, num_measurements=2, layers=2, seed=0, executor=None):
+  # Time-to-target is the wall time until any measured energy first reaches
+  # the task's target.
+  random.seed(seed)
+  numpy.random.seed(seed)
+  start    = time.perf_counter()
+  recorder = _Recorder(task.energy, task.target, start)
+
+  def data():
+    return task.initial(state_capacity), recorder
+
+  def constructor(weights):
+    return decoder(task, weights, state_capacity)
+
+  optimizer = resonators.Optimizer(
+    quota=quota,
+    num_measurements=num_measurements,
+    state_capacity=num_particles,
+    momentum_factor=0.9,
+    residual_factor=0.9,
+    weight_decay=0.0,
+    learning_rate=0.1,
+  )
+  optimizer(numpy.zeros(num_weights(task, layers)), constructor, data, executor=executor, seed=seed)
+  seconds = time.perf_counter()-start
+  # Every step measures each particle and the average on every sample.
+  count   = quota*(num_particles+1)*num_measurements
+  return {
+    'benchmark': 'optimizer',
+    'task': task.name,
+    'state_capacity': state_capacity,
+    'layers': layers,
+    'num_particles': num_particles,
+    'quota': quota,
+    'parallel': executor is not None,
+    'seconds': seconds,
+    'measurements': count,
+    'measurements_per_second': count/seconds,
+    'best_energy': float(recorder.best),
+    'target': task.target,
+    'time_to_target': recorder.reached,
+  }
+
+def run(names=None, sizes=(8, 32, 128), seed=0, executor=None):
+  # Yields records as they are measured. An error in a task ends that task
+  # with an error record.
+  for name in names or TASKS:
+    try:
+      task = TASKS[name]()
+      for state_capacity in sizes:
+        yield bench_decoder(task, state_capacity, seed=seed, executor=executor)
+        yield bench_optimizer(task, state_capacity, seed=seed, executor=executor)
+    except Exception as err:
+      yield {
+        'benchmark': 'error',
+        'task': name,
+        'error': f'{type(err).__name__}: {err}',
+      }
+
+def main(argv):
+  meta = {
+    'python': platform.python_version(),
+    'numpy': numpy.__version__,
+    'machine': platform.machine(),
+  }
+  workers = 0
+  if argv[:1] == ['--workers']:
+    workers = int(argv[1])
+    argv    = argv[2:]
+  executor = None
+  if workers > 0:
+    executor = concurrent.futures.ProcessPoolExecutor(workers)
+  try:
+    for record in run(argv or None, executor=executor):
+      print(json.dumps({**meta, **record}), flush=True)
+  finally:
+    if executor is not None:
+      executor.shutdown()
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,302 @@
+import os
+import time
+import queue
+import hashlib
+import threading
+import collections
+import dataclasses
+import concurrent.futures
+
+import torch
+
+# Shared by stable_diffusion.Model and playground.Model. A model only needs
+# `generate(text, cotext, generators, xsize, ysize, num_inference_steps,
+# guidance_scale)` and `generators(random_seed, count)` to be queued.
+
+def seeded_generators(random_seed, count, device='cpu'):
+  # Image i of a request is drawn from its own generator seeded with
+  # `random_seed+i`, or with `random_seed[i]` given a list, so it does not
+  # depend on what else is in the batch. Both models seed on the CPU: the
+  # SD3 pipeline is spread over devices with device_map='balanced', so it
+  # has no single device to seed on, and CPU streams give the same
+  # latents for a seed whichever device a model runs on.
+  if isinstance(random_seed, int):
+    seeds = range(random_seed, random_seed+count)
+  else:
+    seeds = list(random_seed)
+    assert len(seeds) == count
+  return [torch.Generator(device).manual_seed(seed) for seed in seeds]
+
+def encoder_key(pipeline):
+  # Names the text encoders and tokenizers `pipeline` actually uses, by
+  # class and config (including the checkpoint path it was loaded from),
+  # so embeddings from an injected pipeline are not mixed up with those
+  # of the default checkpoint. Weights are not hashed: two pipelines built
+  # from the same config by hand share a key.
+  parts = []
+  for name in ('text_encoder', 'text_encoder_2', 'text_encoder_3', 'tokenizer', 'tokenizer_2', 'tokenizer_3'):
+    component = getattr(pipeline, name, None)
+    if component is None:
+      continue
+    config = getattr(component, 'config', None)
+    if config is not None:
+      detail = config.to_json_string(use_diff=False)
+    else:
+      detail = f'{component.name_or_path}\0{len(component)}\0{component.model_max_length}'
+    parts.append(f'{name}={type(component).__name__}:{detail}')
+  return hashlib.sha256('\0'.join(parts).encode()).hexdigest()
+
+class EmbeddingCache:
+  # LRU map from (encoder, text) to the text encoders' output for that text,
+  # e.g. (prompt_embeds, pooled_prompt_embeds), where `encoder` identifies
+  # the encoders, e.g. `encoder_key(pipeline)`. Entries are evicted once
+  # their tensors exceed `budget` bytes. With `path`, entries are also
+  # written to that directory and a miss in memory is looked up there
+  # before encoding, so repeat prompts survive restarts.
+  budget: int
+  path: str | None
+  hits: int
+  disk_hits: int
+  misses: int
+
+  def __init__(self, budget=2**30, path=None):
+    self.budget    = budget
+    self.path      = path
+    self.entries   = collections.OrderedDict()
+    self.nbytes    = 0
+    self.hits      = 0
+    self.disk_hits = 0
+    self.misses    = 0
+    self.lock      = threading.Lock()
+    if path is not None:
+      os.makedirs(path, exist_ok=True)
+
+  def __len__(self):
+    return len(self.entries)
+
+  @staticmethod
+  def key(encoder, text):
+    return hashlib.sha256(f'{encoder}\0{text}'.encode()).hexdigest()
+
+  def get(self, encoder, text, encode):
+    # Returns the cached tensors for `text`, calling `encode(text)` on a miss.
+    key = self.key(encoder, text)
+    with self.lock:
+      if key in self.entries:
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return self.entries[key]
+    tensors = self.__load(key)
+    if tensors is None:
+      tensors = tuple(encode(text))
+      self.__store(key, tensors)
+    with self.lock:
+      if key not in self.entries:
+        self.entries[key] = tensors
+        self.nbytes      += sum(tensor.nbytes for tensor in tensors)
+        self.__evict()
+    return tensors
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.nbytes = 0
+
+  def __file(self, key):
+    return os.path.join(self.path, f'{key}.pt')
+
+  def __load(self, key):
+    if self.path is None or not os.path.exists(self.__file(key)):
+      with self.lock:
+        self.misses += 1
+      return None
+    tensors = tuple(torch.load(self.__file(key), map_location='cpu'))
+    with self.lock:
+      self.disk_hits += 1
+    return tensors
+
+  def __store(self, key, tensors):
+    if self.path is None:
+      return
+    staging = self.__file(key)+f'.{os.getpid()}.{threading.get_ident()}'
+    torch.save([tensor.detach().cpu() for tensor in tensors], staging)
+    os.replace(staging, self.__file(key))
+
+  def __evict(self):
+    while self.nbytes > self.budget and len(self.entries) > 1:
+      (_, tensors) = self.entries.popitem(last=False)
+      self.nbytes -= sum(tensor.nbytes for tensor in tensors)
+
+def prompt_embeddings(cache, encoder, encode, text, cotext, device):
+  # Pipeline keyword arguments that replace `prompt`/`negative_prompt`
+  # with cached embeddings. `encode(text)` returns (embeds, pooled) for a
+  # single text.
+  def embed(prompts):
+    pairs = [cache.get(encoder, prompt, encode) for prompt in prompts]
+    return (
+      torch.cat([embeds for embeds, _ in pairs]).to(device),
+      torch.cat([pooled for _, pooled in pairs]).to(device),
+    )
+  (prompt_embeds, pooled_prompt_embeds)                   = embed(text)
+  (negative_prompt_embeds, negative_pooled_prompt_embeds) = embed(cotext)
+  return {
+    'prompt_embeds': prompt_embeds,
+    'negative_prompt_embeds': negative_prompt_embeds,
+    'pooled_prompt_embeds': pooled_prompt_embeds,
+    'negative_pooled_prompt_embeds': negative_pooled_prompt_embeds,
+  }
+
+@dataclasses.dataclass
+class ImageRequest:
+  text: list[str]
+  cotext: list[str]
+  random_seed: int | list[int]
+  settings: tuple
+  future: concurrent.futures.Future
+
+  @property
+  def size(self):
+    return len(self.text)
+
+class ImageQueue:
+  # Packs requests from many callers into pipeline batches. Only requests
+  # with the same (xsize, ysize, num_inference_steps, guidance_scale) can
+  # share a batch; the oldest waiting request picks the settings and is
+  # joined by compatible requests, oldest first, while they fit in
+  # `max_batch_size` images. A request larger than that runs on its own.
+  model: object
+  max_batch_size: int
+  max_wait: float
+
+  def __init__(self, model, max_batch_size=4, max_wait=0.05):
+    self.model          = model
+    self.max_batch_size = max_batch_size
+    self.max_wait       = max_wait
+    self.requests       = queue.Queue()
+    self.waiting        = []
+    self.closed         = False
+    self.lock           = threading.Lock()
+    self.worker         = threading.Thread(target=self.__run, daemon=True)
+    self.worker.start()
+
+  def submit(
+    self,
+    text: str | list[str],
+    cotext: str | list[str] = '',
+    xsize: int = 1024,
+    ysize: int = 1024,
+    num_inference_steps: int = 50,
+    guidance_scale: float = 3.0,
+    random_seed: int | list[int] = 0,
+    batch_size: int = 1,
+  ) -> concurrent.futures.Future:
+    # Requests are checked here rather than in the worker, where a bad
+    # one would fail every request packed into the same batch.
+    if isinstance(text, str):
+      text = [text]*batch_size
+    if isinstance(cotext, str):
+      cotext = [cotext]*len(text)
+    if len(text) != len(cotext):
+      raise ValueError(f'ImageQueue.submit: {len(text)} texts but {len(cotext)} cotexts')
+    if not isinstance(random_seed, int) and len(random_seed) != len(text):
+      raise ValueError(f'ImageQueue.submit: {len(text)} images but {len(random_seed)} seeds')
+    future   = concurrent.futures.Future()
+    settings = (xsize, ysize, num_inference_steps, guidance_scale)
+    request  = ImageRequest(list(text), list(cotext), random_seed, settings, future)
+    with self.lock:
+      if self.closed:
+        raise RuntimeError('ImageQueue.submit: queue is closed')
+      self.requests.put(request)
+    return future
+
+  def __call__(self, *args, **kwargs):
+    return self.submit(*args, **kwargs).result()
+
+  def close(self):
+    with self.lock:
+      if self.closed:
+        return
+      self.closed = True
+      self.requests.put(None)
+    self.worker.join()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def __collect(self):
+    if not self.waiting:
+      request = self.requests.get()
+      if request is None:
+        return False
+      self.waiting.append(request)
+    deadline = time.monotonic()+self.max_wait
+    while sum(request.size for request in self.waiting) < self.max_batch_size:
+      timeout = deadline-time.monotonic()
+      if timeout <= 0:
+        break
+      try:
+        request = self.requests.get(timeout=timeout)
+      except queue.Empty:
+        break
+      if request is None:
+        self.closed = True
+        break
+      self.waiting.append(request)
+    return True
+
+  def __batch(self):
+    # Requests whose futures were cancelled while waiting are dropped; the
+    # ones taken into the batch are marked running, so they can no longer
+    # be cancelled.
+    self.waiting = [request for request in self.waiting if not request.future.cancelled()]
+    if not self.waiting:
+      return []
+    (oldest, *rest) = self.waiting
+    batch = [oldest]
+    size  = oldest.size
+    for request in rest:
+      if request.settings == oldest.settings and size+request.size <= self.max_batch_size:
+        batch.append(request)
+        size += request.size
+    chosen = set(map(id, batch))
+    self.waiting = [request for request in self.waiting if id(request) not in chosen]
+    return [request for request in batch if request.future.set_running_or_notify_cancel()]
+
+  def __run(self):
+    while self.__collect() or self.waiting:
+      batch = self.__batch() if self.waiting else []
+      if batch:
+        try:
+          self.__generate(batch)
+        except Exception as err:
+          for request in batch:
+            if not request.future.done():
+              request.future.set_exception(err)
+      if self.closed and self.requests.empty() and not self.waiting:
+        break
+
+  def __generate(self, batch):
+    (xsize, ysize, num_inference_steps, guidance_scale) = batch[0].settings
+    text       = []
+    cotext     = []
+    generators = []
+    for request in batch:
+      text.extend(request.text)
+      cotext.extend(request.cotext)
+      generators.extend(self.model.generators(request.random_seed, request.size))
+    images = self.model.generate(
+      text,
+      cotext,
+      generators,
+      xsize=xsize,
+      ysize=ysize,
+      num_inference_steps=num_inference_steps,
+      guidance_scale=guidance_scale,
+    )
+    start = 0
+    for request in batch:
+      request.future.set_result(images[start:start+request.size])
+      start += request.size
@@ -1,6 +1,784 @@
+import copy
+import json
+import math
+import time
+import hashlib
+import sqlite3
+import queue
+import weakref
+import threading
+import collections
+import concurrent.futures
+
 import torch
+import dataclasses
 import transformers
 
+def _crop(cache, length):
+  # Negative crops remove tokens from the end in every cache version.
+  excess = cache.get_seq_length()-length
+  if excess > 0:
+    cache.crop(-excess)
+
+def _head(cache, length):
+  # A new cache holding copies of the first `length` positions of row 0,
+  # without copying the rest of `cache`.
+  head = transformers.DynamicCache()
+  for index, layer in enumerate(cache.layers):
+    head.update(
+      layer.keys[:1, :, :length].clone(),
+      layer.values[:1, :, :length].clone(),
+      index,
+    )
+  return head
+
+class Generation:
+  # Token-by-token sampling for a batch of prompts with one shared KV cache.
+  # Prompts are left-padded so every row's next token sits in the last
+  # column; `drop` removes finished rows from the batch and the cache so
+  # they stop costing compute while the others keep decoding.
+  model: transformers.AutoModelForCausalLM
+  temperature: float
+  rows: list[int]
+  tokens: list[list[int]]
+
+  def __init__(
+    self,
+    model,
+    prompts: list[list[int]],
+    pad_token_id: int,
+    temperature: float,
+    processors: list = (),
+    num_samples: int = 1,
+    past_key_values = None,
+    past_length: int = 0,
+    generator: torch.Generator = None,
+    warpers: list = (),
+  ):
+    # With `past_key_values`, each prompt continues a cached prefix of
+    # `past_length` tokens and only the new tokens are prefilled. Sampling
+    # draws from `generator` if given, so a seeded generation is replayable.
+    # `processors` see the raw logits; `warpers` (top-k, top-p, ...) see
+    # them after temperature scaling, in the same order as model.generate.
+    device  = model.device
+    length  = max(len(prompt) for prompt in prompts)
+    padded  = [[pad_token_id]*(length-len(prompt))+prompt for prompt in prompts]
+    masks   = [[1]*past_length+[0]*(length-len(prompt))+[1]*len(prompt) for prompt in prompts]
+    self.model          = model
+    self.temperature    = temperature
+    self.processors     = processors
+    self.generator      = generator
+    self.warpers        = warpers
+    self.past_length    = past_length
+    self.rows           = list(range(len(prompts)))
+    self.tokens         = [[] for _ in prompts]
+    self.sequences      = torch.tensor(padded, dtype=torch.long, device=device)
+    self.attention_mask = torch.tensor(masks, dtype=torch.long, device=device)
+    self.positions      = (self.attention_mask.cumsum(-1)-1).clamp(min=0)[:, past_length:]
+    self.cache          = past_key_values
+    self.pending        = None
+    self.logits         = self.__forward(self.sequences, self.positions)
+    self.positions      = self.positions[:, -1:]
+    if num_samples > 1:
+      # Prefill once per prompt, then fan the cache out to `num_samples`
+      # rows that continue independently.
+      self.cache.batch_repeat_interleave(num_samples)
+      self.rows           = list(range(len(prompts)*num_samples))
+      self.tokens         = [[] for _ in self.rows]
+      self.sequences      = self.sequences.repeat_interleave(num_samples, dim=0)
+      self.attention_mask = self.attention_mask.repeat_interleave(num_samples, dim=0)
+      self.positions      = self.positions.repeat_interleave(num_samples, dim=0)
+      self.logits         = self.logits.repeat_interleave(num_samples, dim=0)
+
+  @property
+  def active(self):
+    return len(self.rows) > 0
+
+  @torch.no_grad()
+  def __forward(self, input_ids, position_ids):
+    output = self.model(
+      input_ids=input_ids,
+      attention_mask=self.attention_mask,
+      position_ids=position_ids,
+      past_key_values=self.cache,
+      use_cache=True,
+    )
+    self.cache = output.past_key_values
+    return output.logits[:, -1, :].float()
+
+  def __sample(self, logits):
+    for processor in self.processors:
+      logits = processor(self.sequences, logits)
+    if self.temperature <= 0:
+      return logits.argmax(-1)
+    logits = logits/self.temperature
+    for warper in self.warpers:
+      logits = warper(self.sequences, logits)
+    probabilities = torch.softmax(logits, dim=-1)
+    return torch.multinomial(probabilities, 1, generator=self.generator)[:, 0]
+
+  def step(self):
+    # Returns (row, token) for every active row. The forward pass for the
+    # previous step's tokens runs lazily here, so rows dropped in between
+    # are never computed.
+    if self.pending is not None:
+      ones                = torch.ones_like(self.pending[:, None])
+      self.attention_mask = torch.cat([self.attention_mask, ones], dim=-1)
+      self.positions      = self.positions+1
+      self.logits         = self.__forward(self.pending[:, None], self.positions)
+    self.pending   = self.__sample(self.logits)
+    self.sequences = torch.cat([self.sequences, self.pending[:, None]], dim=-1)
+    output = []
+    for row, token in zip(self.rows, self.pending.tolist()):
+      self.tokens[row].append(token)
+      output.append((row, token))
+    return output
+
+  def drop(self, rows):
+    rows = set(rows)
+    keep = [index for index, row in enumerate(self.rows) if row not in rows]
+    if len(keep) == len(self.rows):
+      return
+    self.rows = [self.rows[index] for index in keep]
+    if not self.rows:
+      return
+    index = torch.tensor(keep, dtype=torch.long, device=self.sequences.device)
+    self.cache.batch_select_indices(index)
+    self.sequences      = self.sequences[index]
+    self.attention_mask = self.attention_mask[index]
+    self.positions      = self.positions[index]
+    self.logits         = self.logits[index]
+    if self.pending is not None:
+      self.pending = self.pending[index]
+    for processor in self.processors:
+      if hasattr(processor, 'select'):
+        processor.select(index)
+
+class Detokenizer:
+  # Incremental decoding: only the tokens since the last emitted boundary
+  # are decoded at each step, and text is held back while it ends in an
+  # incomplete UTF-8 sequence.
+  tokens: list[int]
+
+  def __init__(self, tokenizer):
+    self.tokenizer     = tokenizer
+    self.tokens        = []
+    self.prefix_offset = 0
+    self.read_offset   = 0
+
+  def __decode(self, tokens):
+    return self.tokenizer.decode(tokens, skip_special_tokens=True)
+
+  def push(self, token):
+    self.tokens.append(token)
+    prefix = self.__decode(self.tokens[self.prefix_offset:self.read_offset])
+    text   = self.__decode(self.tokens[self.prefix_offset:])
+    if len(text) <= len(prefix) or text.endswith('\ufffd'):
+      return ''
+    self.prefix_offset = self.read_offset
+    self.read_offset   = len(self.tokens)
+    return text[len(prefix):]
+
+LISP_CODE   = 0
+LISP_STRING = 1
+LISP_ESCAPE = 2
+
+def lisp_scan(text, depth=0, mode=LISP_CODE):
+  # Runs the Lisp reader's paren and string rules over `text` from the
+  # given state. Returns the final depth, the lowest depth reached and the
+  # final mode; a prefix can still be completed to a readable program
+  # exactly when the lowest depth never drops below zero.
+  # Like `lisp.is_end_string`, a quote ends a string unless the character
+  # right before it is a backslash; LISP_ESCAPE only records that, so in
+  # "a\\" the second backslash does not undo the first.
+  lowest = depth
+  for char in text:
+    if mode == LISP_ESCAPE:
+      if char != '\\':
+        mode = LISP_STRING
+    elif mode == LISP_STRING:
+      if char == '\\':
+        mode = LISP_ESCAPE
+      elif char == '"':
+        mode = LISP_CODE
+    elif char == '(':
+      depth += 1
+    elif char == ')':
+      depth -= 1
+      lowest = min(lowest, depth)
+    elif char == '"':
+      mode = LISP_STRING
+  return depth, lowest, mode
+
+class LispPrefix:
+  # Incremental validator for `Llama.reduce`: fed text deltas, it stays
+  # true while the text so far is a prefix of a well-formed program.
+  depth: int
+  mode: int
+
+  def __init__(self):
+    self.depth = 0
+    self.mode  = LISP_CODE
+
+  @property
+  def is_complete(self):
+    return self.depth == 0 and self.mode == LISP_CODE
+
+  def __call__(self, delta):
+    (self.depth, lowest, self.mode) = lisp_scan(delta, self.depth, self.mode)
+    return lowest >= 0
+
+class LispGrammar:
+  # Per-token transition tables for `lisp_scan`: for every token and every
+  # scanner mode it could start in, the change in depth, the lowest depth
+  # reached relative to the start, and the mode it ends in. Building one
+  # decodes the whole vocabulary, so `shared` keeps one per tokenizer and
+  # terminators for as long as the tokenizer is alive; `processor()` makes
+  # the per-generation logits processor.
+  terminators: list[int]
+
+  def __init__(self, tokenizer, terminators):
+    self.terminators = [token for token in terminators if token is not None]
+    size   = len(tokenizer)
+    delta  = torch.zeros((3, size), dtype=torch.long)
+    lowest = torch.zeros((3, size), dtype=torch.long)
+    modes  = torch.zeros((3, size), dtype=torch.long)
+    blank  = torch.zeros(size, dtype=torch.bool)
+    for token in range(size):
+      text         = tokenizer.decode([token])
+      blank[token] = text.strip() == '' or token in self.terminators
+      for mode in (LISP_CODE, LISP_STRING, LISP_ESCAPE):
+        (depth, low, end)    = lisp_scan(text, 0, mode)
+        delta[mode, token]  = depth
+        lowest[mode, token] = low
+        modes[mode, token]  = end
+    self.delta  = delta
+    self.lowest = lowest
+    self.modes  = modes
+    self.blank  = blank
+    self.tables = {}
+
+  def tables_for(self, device, size):
+    # Logits may be wider than the tokenizer (padded embeddings); the extra
+    # ids are never allowed.
+    key = (str(device), size)
+    if key not in self.tables:
+      extra  = size-self.delta.shape[1]
+      delta  = torch.nn.functional.pad(self.delta, (0, extra))
+      lowest = torch.nn.functional.pad(self.lowest, (0, extra), value=-2**30)
+      modes  = torch.nn.functional.pad(self.modes, (0, extra))
+      blank  = torch.nn.functional.pad(self.blank, (0, extra), value=True)
+      self.tables[key] = tuple(table.to(device) for table in (delta, lowest, modes, blank))
+    return self.tables[key]
+
+  @classmethod
+  def shared(cls, tokenizer, terminators):
+    terminators = tuple(token for token in terminators if token is not None)
+    with _LISP_GRAMMARS_LOCK:
+      grammars = _LISP_GRAMMARS.setdefault(tokenizer, {})
+      if terminators not in grammars:
+        grammars[terminators] = cls(tokenizer, terminators)
+      return grammars[terminators]
+
+  def processor(self):
+    return LispLogitsProcessor(self)
+
+_LISP_GRAMMARS      = weakref.WeakKeyDictionary()
+_LISP_GRAMMARS_LOCK = threading.Lock()
+
+class LispLogitsProcessor(transformers.LogitsProcessor):
+  # Masks every token that would make the output unreadable: a `)` below
+  # depth zero, or a terminator while a list or string is still open or
+  # before anything but whitespace has been written. Works with
+  # `model.generate(logits_processor=...)` as well as Generation.
+  grammar: LispGrammar
+
+  def __init__(self, grammar):
+    self.grammar  = grammar
+    self.seen     = None
+    self.depth    = None
+    self.mode     = None
+    self.nonblank = None
+
+  def select(self, index):
+    self.depth    = self.depth[index]
+    self.mode     = self.mode[index]
+    self.nonblank = self.nonblank[index]
+
+  def __call__(self, input_ids, scores):
+    (delta, lowest, modes, blank) = self.grammar.tables_for(scores.device, scores.shape[-1])
+    if self.seen is None:
+      rows          = input_ids.shape[0]
+      self.seen     = input_ids.shape[1]
+      self.depth    = torch.zeros(rows, dtype=torch.long, device=scores.device)
+      self.mode     = torch.full((rows,), LISP_CODE, dtype=torch.long, device=scores.device)
+      self.nonblank = torch.zeros(rows, dtype=torch.bool, device=scores.device)
+    for column in range(self.seen, input_ids.shape[1]):
+      token         = input_ids[:, column]
+      self.depth    = self.depth+delta[self.mode, token]
+      self.nonblank = self.nonblank | ~blank[token]
+      self.mode     = modes[self.mode, token]
+    self.seen = input_ids.shape[1]
+    invalid = self.depth[:, None]+lowest[self.mode] < 0
+    closed  = (self.depth == 0) & (self.mode == LISP_CODE) & self.nonblank
+    terminators = torch.tensor(self.grammar.terminators, device=scores.device)
+    invalid[:, terminators] = ~closed[:, None]
+    return scores.masked_fill(invalid, -float('inf'))
+
+def _kv_bytes_per_token(model):
+  config   = model.config
+  heads    = getattr(config, 'num_key_value_heads', None) or config.num_attention_heads
+  head_dim = getattr(config, 'head_dim', None) or config.hidden_size//config.num_attention_heads
+  itemsize = torch.finfo(model.dtype).bits//8
+  return 2*config.num_hidden_layers*heads*head_dim*itemsize
+
+def _clock(device):
+  # Wall time after the device has finished its queued work, so prefill
+  # and decode are not charged to whichever side happens to synchronize.
+  if device.type == 'cuda':
+    torch.cuda.synchronize(device)
+  return time.perf_counter()
+
+@dataclasses.dataclass
+class CallMetrics:
+  # Token counts and timings for one `get`, `stream`, `Session.get` or
+  # `reduce` call. `cached_tokens` is the part of the prompt whose
+  # key/values were reused instead of prefilled. For `reduce`, `samples`
+  # is the quota consumed and the rest counts its continuations.
+  kind: str
+  prompt_tokens: int = 0
+  cached_tokens: int = 0
+  generated_tokens: int = 0
+  prefill_seconds: float = 0.0
+  decode_seconds: float = 0.0
+  samples: int = 0
+  valid: int = 0
+  aborted: int = 0
+  aborted_tokens: int = 0
+
+  @property
+  def seconds(self):
+    return self.prefill_seconds+self.decode_seconds
+
+  @property
+  def tokens_per_second(self):
+    if self.decode_seconds == 0:
+      return 0.0
+    return self.generated_tokens/self.decode_seconds
+
+  @property
+  def abort_rate(self):
+    if self.samples == 0:
+      return 0.0
+    return self.aborted/self.samples
+
+  def as_dict(self):
+    return {
+      **dataclasses.asdict(self),
+      'seconds': self.seconds,
+      'tokens_per_second': self.tokens_per_second,
+    }
+
+class Histogram:
+  # Counts in power-of-two buckets: bucket e holds values in [2**(e-1), 2**e).
+  # Quantiles are reported as bucket upper bounds.
+  count: int
+  total: float
+
+  def __init__(self):
+    self.buckets = collections.Counter()
+    self.count   = 0
+    self.total   = 0.0
+    self.min     = float('inf')
+    self.max     = float('-inf')
+
+  def add(self, value):
+    exponent = math.frexp(value)[1] if value > 0 else -1074
+    self.buckets[exponent] += 1
+    self.count += 1
+    self.total += value
+    self.min    = min(self.min, value)
+    self.max    = max(self.max, value)
+
+  def quantile(self, q):
+    if self.count == 0:
+      return 0.0
+    rank = q*self.count
+    seen = 0
+    for exponent in sorted(self.buckets):
+      seen += self.buckets[exponent]
+      if seen >= rank:
+        return min(math.ldexp(1.0, exponent), self.max)
+    return self.max
+
+  def summary(self):
+    if self.count == 0:
+      return { 'count': 0 }
+    return {
+      'count': self.count,
+      'total': self.total,
+      'mean': self.total/self.count,
+      'min': self.min,
+      'max': self.max,
+      'p50': self.quantile(0.5),
+      'p90': self.quantile(0.9),
+      'p99': self.quantile(0.99),
+    }
+
+class LlamaMetrics:
+  # Aggregates CallMetrics into one histogram per (kind, field). Every
+  # recorded call is also passed to each of `exporters`, e.g. `json_lines`.
+  FIELDS = (
+    'prompt_tokens',
+    'cached_tokens',
+    'generated_tokens',
+    'prefill_seconds',
+    'decode_seconds',
+    'tokens_per_second',
+    'samples',
+    'abort_rate',
+  )
+  exporters: list
+
+  def __init__(self, exporters=()):
+    self.exporters  = list(exporters)
+    self.histograms = collections.defaultdict(Histogram)
+    self.lock       = threading.Lock()
+
+  def record(self, call):
+    with self.lock:
+      for field in self.FIELDS:
+        self.histograms[call.kind, field].add(getattr(call, field))
+    for exporter in self.exporters:
+      exporter(call)
+
+  def summary(self):
+    output = collections.defaultdict(dict)
+    with self.lock:
+      for (kind, field), histogram in self.histograms.items():
+        output[kind][field] = histogram.summary()
+    return dict(output)
+
+  def reset(self):
+    with self.lock:
+      self.histograms.clear()
+
+def json_lines(file):
+  # An exporter that writes one JSON object per call to an open file.
+  def exporter(call):
+    file.write(json.dumps(call.as_dict())+'\n')
+    file.flush()
+  return exporter
+
+class PrefixEntry:
+  tokens: int
+  nbytes: int
+  references: int
+
+  def __init__(self, node, cache, tokens, nbytes):
+    self.node       = node
+    self.cache      = cache
+    self.tokens     = tokens
+    self.nbytes     = nbytes
+    self.references = 0
+
+class PrefixCache:
+  # Past key/values of shared prompt prefixes, such as the system prompt or
+  # a few-shot preamble, in a trie over token ids with one root per model.
+  # `attach` copies the longest stored prefix of a prompt into a fresh
+  # cache, holding a reference to the entry while it does; entries with no
+  # references are evicted least-recently-used first once the total
+  # exceeds `budget` bytes.
+  budget: int
+
+  def __init__(self, budget=2**30):
+    self.budget  = budget
+    self.roots   = {}
+    self.entries = collections.OrderedDict()
+    self.lock    = threading.RLock()
+    self.hits    = 0
+    self.misses  = 0
+
+  @property
+  def total_bytes(self):
+    return sum(entry.nbytes for entry in self.entries.values())
+
+  def __root(self, model):
+    key = id(model)
+    if key not in self.roots:
+      self.roots[key] = {}
+      weakref.finalize(model, self.drop, key)
+    return self.roots[key]
+
+  def drop(self, key):
+    with self.lock:
+      stack = [self.roots.pop(key, {})]
+      while stack:
+        node  = stack.pop()
+        entry = node.get(None)
+        if entry is not None:
+          self.entries.pop(id(entry), None)
+        stack += [child for token, child in node.items() if token is not None]
+
+  def lookup(self, model, tokens):
+    with self.lock:
+      node = self.__root(model)
+      best = None
+      for token in tokens:
+        node = node.get(token)
+        if node is None:
+          break
+        if None in node:
+          best = node[None]
+      if best is None:
+        self.misses += 1
+        return None
+      self.hits += 1
+      best.references += 1
+      self.entries.move_to_end(id(best))
+      return best
+
+  def release(self, entry):
+    with self.lock:
+      entry.references -= 1
+      self.__evict()
+
+  def attach(self, model, tokens):
+    entry = self.lookup(model, tokens)
+    if entry is None:
+      return None, 0
+    try:
+      return copy.deepcopy(entry.cache), entry.tokens
+    finally:
+      self.release(entry)
+
+  def insert(self, model, tokens, cache, nbytes):
+    with self.lock:
+      node = self.__root(model)
+      for token in tokens:
+        node = node.setdefault(token, {})
+      if None not in node:
+        entry       = PrefixEntry(node, cache, len(tokens), nbytes)
+        node[None]  = entry
+        self.entries[id(entry)] = entry
+      self.__evict()
+
+  def __evict(self):
+    total = self.total_bytes
+    for key in list(self.entries):
+      if total <= self.budget:
+        break
+      entry = self.entries[key]
+      if entry.references > 0:
+        continue
+      total -= entry.nbytes
+      del self.entries[key]
+      del entry.node[None]
+
+PREFIX_CACHE = PrefixCache()
+
+class GenerationCache:
+  # Completed generations on disk, content-addressed by a digest of
+  # everything that determines them. Entries are evicted least recently
+  # used first once their text exceeds `budget` bytes.
+  path: str
+  budget: int
+  hits: int
+  misses: int
+
+  def __init__(self, path, budget=2**28):
+    self.path   = path
+    self.budget = budget
+    self.hits   = 0
+    self.misses = 0
+    self.lock   = threading.Lock()
+    self.db     = sqlite3.connect(path, check_same_thread=False)
+    self.db.execute(
+      'CREATE TABLE IF NOT EXISTS generations '
+      '(key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, used REAL NOT NULL)'
+    )
+    self.db.execute('CREATE INDEX IF NOT EXISTS generations_used ON generations (used)')
+    self.db.commit()
+
+  @staticmethod
+  def key(**fields):
+    encoded = json.dumps(fields, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+  @property
+  def hit_rate(self):
+    total = self.hits+self.misses
+    if total == 0:
+      return 0.0
+    return self.hits/total
+
+  @property
+  def total_bytes(self):
+    with self.lock:
+      (total,) = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM generations').fetchone()
+    return total
+
+  def get(self, key):
+    with self.lock:
+      row = self.db.execute('SELECT value FROM generations WHERE key = ?', (key,)).fetchone()
+      if row is None:
+        self.misses += 1
+        return None
+      self.hits += 1
+      self.db.execute('UPDATE generations SET used = ? WHERE key = ?', (time.time(), key))
+      self.db.commit()
+      return row[0]
+
+  def put(self, key, value):
+    size = len(value.encode())
+    with self.lock:
+      self.db.execute(
+        'INSERT OR REPLACE INTO generations (key, value, size, used) VALUES (?, ?, ?, ?)',
+        (key, value, size, time.time()),
+      )
+      self.__evict()
+      self.db.commit()
+
+  def clear(self):
+    with self.lock:
+      self.db.execute('DELETE FROM generations')
+      self.db.commit()
+
+  def close(self):
+    self.db.close()
+
+  def __evict(self):
+    (total,) = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM generations').fetchone()
+    if total <= self.budget:
+      return
+    stale = []
+    for key, size in self.db.execute('SELECT key, size FROM generations ORDER BY used'):
+      if total <= self.budget:
+        break
+      stale.append((key,))
+      total -= size
+    self.db.executemany('DELETE FROM generations WHERE key = ?', stale)
+
+def _load_tokenizer(model_name, cache_dir, local_files_only):
+  return transformers.AutoTokenizer.from_pretrained(
+    model_name,
+    cache_dir=cache_dir,
+    local_files_only=local_files_only,
+  )
+
+def _load_model(model_name, cache_dir, local_files_only):
+  return transformers.AutoModelForCausalLM.from_pretrained(
+    model_name,
+    device_map='auto',
+    # TODO: There was some FUD about Llama 3 quantization being a
+    # problem, is there any truth to this?
+    load_in_8bit=True,
+    cache_dir=cache_dir,
+    local_files_only=local_files_only,
+  )
+
+def _estimate_model(model_name, cache_dir, local_files_only):
+  # Bytes `_load_model` will take, from the config alone: the model is
+  # built on the meta device, and linear layers count one byte per weight
+  # as load_in_8bit leaves everything else, lm_head included, unquantized.
+  config = transformers.AutoConfig.from_pretrained(
+    model_name,
+    cache_dir=cache_dir,
+    local_files_only=local_files_only,
+  )
+  with torch.device('meta'):
+    model = transformers.AutoModelForCausalLM.from_config(config)
+  output = model.get_output_embeddings()
+  nbytes = 0
+  for module in model.modules():
+    for parameter in module.parameters(recurse=False):
+      if isinstance(module, torch.nn.Linear) and module is not output and parameter.dim() == 2:
+        nbytes += parameter.numel()
+      else:
+        nbytes += parameter.numel()*parameter.element_size()
+  return nbytes
+
+class ModelRegistry:
+  # Tokenizers and models loaded on first use and shared by key, which is
+  # (model name, cache_dir, local_files_only). Tokenizers are small and
+  # stay loaded. Before a model is loaded, least recently used models are
+  # unloaded until its size fits in `budget` bytes: the footprint seen the
+  # last time it was loaded, or `_estimate_model` the first time. Models
+  # can also be unloaded explicitly with `unload_idle`. A model stays alive
+  # while a generation still holds it, so the budget only bounds what the
+  # registry itself keeps.
+  budget: int | None
+
+  def __init__(self, budget=None):
+    self.budget     = budget
+    self.tokenizers = {}
+    self.models     = collections.OrderedDict()
+    self.used       = {}
+    self.sizes      = {}
+    self.lock       = threading.RLock()
+
+  @property
+  def total_bytes(self):
+    return sum(self.sizes[key] for key in self.models)
+
+  def tokenizer(self, key):
+    with self.lock:
+      if key not in self.tokenizers:
+        self.tokenizers[key] = _load_tokenizer(*key)
+      return self.tokenizers[key]
+
+  def model(self, key):
+    with self.lock:
+      if key in self.models:
+        self.models.move_to_end(key)
+      else:
+        self.__evict(self.__size(key))
+        self.models[key] = _load_model(*key)
+        self.sizes[key]  = self.models[key].get_memory_footprint()
+      self.used[key] = time.monotonic()
+      return self.models[key]
+
+  def loaded(self, key):
+    return key in self.models
+
+  def unload(self, key):
+    with self.lock:
+      if self.models.pop(key, None) is None:
+        return
+      del self.used[key]
+    if torch.cuda.is_available():
+      torch.cuda.empty_cache()
+
+  def unload_idle(self, seconds):
+    # Unloads every model not used in the last `seconds`.
+    now = time.monotonic()
+    with self.lock:
+      idle = [key for key, used in self.used.items() if now-used > seconds]
+    for key in idle:
+      self.unload(key)
+
+  def __size(self, key):
+    if self.budget is None:
+      return 0
+    if key not in self.sizes:
+      self.sizes[key] = _estimate_model(*key)
+    return self.sizes[key]
+
+  def __evict(self, incoming):
+    # Makes room for `incoming` bytes before they are loaded, so the
+    # registry never holds more than `budget` at once unless a single
+    # model is larger than that.
+    if self.budget is None:
+      return
+    total = self.total_bytes
+    for key in list(self.models):
+      if total+incoming <= self.budget:
+        break
+      total -= self.sizes[key]
+      self.unload(key)
+
+MODEL_REGISTRY = ModelRegistry()
+
 class Llama:
   tokenizer: transformers.AutoTokenizer
   model: transformers.AutoModelForCausalLM
@@ -10,6 +788,7 @@ class Llama:
   terminators: list
   purity: int
   quota: int
+  batch_size: int
 
   def __init__(
     self,
@@ -22,33 +801,64 @@ class Llama:
     quota: int = 1000,
     tokenizer = None,
     model = None,
+    batch_size: int = 16,
+    session_budget: int = 2**30,
+    prefix_cache: PrefixCache = PREFIX_CACHE,
+    generation_cache: GenerationCache = None,
+    registry: ModelRegistry = MODEL_REGISTRY,
+    metrics: LlamaMetrics = None,
+    top_k: int = None,
+    top_p: float = None,
   ):
+    # The tokenizer and model are resolved on first use through `registry`,
+    # so constructing a Llama is cheap and
+    # every instance with the same model name and config shares one copy
+    # of the weights. Explicit `tokenizer`/`model` bypass the registry.
     model_name = 'meta-llama/Meta-Llama-3-8B-Instruct'
-    self.tokenizer = tokenizer or transformers.AutoTokenizer.from_pretrained(
-      model_name,
-      cache_dir=cache_dir,
-      local_files_only=local_files_only,
-    )
-    self.model = model or transformers.AutoModelForCausalLM.from_pretrained(
-      model_name,
-      device_map='auto',
-      # TODO: There was some FUD about Llama 3 quantization being a
-      # problem, is there any truth to this?
-      load_in_8bit=True,
-      cache_dir=cache_dir,
-      local_files_only=local_files_only,
-    )
-    self.terminators = [
-      self.tokenizer.eos_token_id,
-      self.tokenizer.convert_tokens_to_ids('<|eot_id|>')
-    ]
-    self.system_prompt  = system_prompt
-    self.temperature    = temperature
-    self.max_new_tokens = max_new_tokens
-    self.purity         = purity
-    self.quota          = quota
+    if model is not None:
+      model_name = getattr(model.config, 'name_or_path', None) or model_name
+    self.model_name       = model_name
+    self.model_key        = (model_name, cache_dir, local_files_only)
+    self.registry         = registry
+    self.own_tokenizer    = tokenizer
+    self.own_model        = model
+    self.own_terminators  = None
+    self.system_prompt    = system_prompt
+    self.temperature      = temperature
+    self.top_k            = top_k
+    self.top_p            = top_p
+    self.max_new_tokens   = max_new_tokens
+    self.purity           = purity
+    self.quota            = quota
+    self.batch_size       = batch_size
+    self.sessions         = SessionStore(session_budget)
+    self.prefix_cache     = prefix_cache
+    self.generation_cache = generation_cache
+    self.metrics          = metrics or LlamaMetrics()
+    self.reduce_stats     = CallMetrics('reduce')
+
+  @property
+  def tokenizer(self):
+    if self.own_tokenizer is not None:
+      return self.own_tokenizer
+    return self.registry.tokenizer(self.model_key)
+
+  @property
+  def model(self):
+    if self.own_model is not None:
+      return self.own_model
+    return self.registry.model(self.model_key)
 
-  def __apply_chat_template(self, state):
+  @property
+  def terminators(self):
+    if self.own_terminators is None:
+      self.own_terminators = [
+        self.tokenizer.eos_token_id,
+        self.tokenizer.convert_tokens_to_ids('<|eot_id|>')
+      ]
+    return self.own_terminators
+
+  def __chat_ids(self, state, add_generation_prompt):
     prompt = [{ 'role': 'system', 'content': self.system_prompt }]
     for index, content in enumerate(state):
       if index%2 == 0:
@@ -56,40 +866,513 @@ class Llama:
       else:
         role = 'assistant'
       prompt.append({ 'role': role, 'content': content })
-    input_ids = self.tokenizer.apply_chat_template(
+    return self.tokenizer.apply_chat_template(
       prompt,
-      #tokenize=True,
-      add_generation_prompt=True,
-      return_tensors='pt',
-    ).to(self.model.device)
+      tokenize=True,
+      add_generation_prompt=add_generation_prompt,
+      return_dict=False,
+    )
 
-    return input_ids
+  def prompt_ids(self, state):
+    return self.__chat_ids(state, True)
 
-  def get(self, state):
-    source_ids = self.__apply_chat_template(state)
-    targets    = self.model.generate(
-      source_ids,
-      max_new_tokens=self.max_new_tokens,
-      do_sample=True,
+  def preamble_ids(self, state=()):
+    return self.__chat_ids(state, False)
+
+  @property
+  def pad_token_id(self):
+    if self.tokenizer.pad_token_id is not None:
+      return self.tokenizer.pad_token_id
+    return self.tokenizer.eos_token_id
+
+  @property
+  def kv_bytes_per_token(self):
+    return _kv_bytes_per_token(self.model)
+
+  # The methods below take the `model` a call resolved once, so a registry
+  # eviction in the middle of a call cannot make it load the weights again.
+
+  def generation(self, prompts, processors=(), num_samples=1, past_key_values=None, past_length=0, generator=None, model=None):
+    if model is None:
+      model = self.model
+    return Generation(
+      model,
+      prompts,
+      self.pad_token_id,
+      self.temperature,
+      processors,
+      num_samples,
+      past_key_values,
+      past_length,
+      generator,
+      self.warpers(model),
+    )
+
+  def sampling(self, model=None):
+    # The effective (top_k, top_p, min_p): the model's generation_config
+    # sampling settings that model.generate applies on top of the
+    # temperature, e.g. Llama 3 Instruct's top_p=0.9. `top_k`/`top_p`
+    # given to the constructor take precedence, and an unset top_k is 50,
+    # as in transformers' own defaults. Settings that do nothing are None.
+    if model is None:
+      model = self.model
+    config = model.generation_config
+    top_k  = self.top_k if self.top_k is not None else getattr(config, 'top_k', None)
+    top_p  = self.top_p if self.top_p is not None else getattr(config, 'top_p', None)
+    min_p  = getattr(config, 'min_p', None)
+    if top_k is None:
+      top_k = 50
+    if top_p is not None and top_p >= 1.0:
+      top_p = None
+    return (top_k or None, top_p, min_p or None)
+
+  def warpers(self, model=None):
+    (top_k, top_p, min_p) = self.sampling(model)
+    output = []
+    if top_k is not None:
+      output.append(transformers.TopKLogitsWarper(top_k))
+    if top_p is not None:
+      output.append(transformers.TopPLogitsWarper(top_p))
+    if min_p is not None:
+      output.append(transformers.MinPLogitsWarper(min_p))
+    return output
+
+  def session(self, state=None):
+    return Session(self, state)
+
+  def cache_prefix(self, state=()):
+    # Store the past key/values of the system prompt followed by `state`,
+    # e.g. few-shot examples, in the prefix cache.
+    model  = self.model
+    prompt = self.preamble_ids(state)
+    with torch.no_grad():
+      output = model(
+        input_ids=torch.tensor([prompt], device=model.device),
+        use_cache=True,
+      )
+    nbytes = len(prompt)*_kv_bytes_per_token(model)
+    self.prefix_cache.insert(model, prompt, output.past_key_values, nbytes)
+
+  def prefilled(self, prompt, num_samples=1, processors=(), past_key_values=None, past_tokens=(), generator=None, model=None):
+    # Starts a generation for `prompt`, reusing as much of it as possible:
+    # the caller's own `past_key_values` over `past_tokens` if given, else
+    # the longest prefix in the prefix cache. The system prompt's key/values
+    # are stored in the prefix cache on first use.
+    if model is None:
+      model = self.model
+    shared = 0
+    if past_key_values is not None:
+      limit = min(len(past_tokens), len(prompt)-1)
+      while shared < limit and past_tokens[shared] == prompt[shared]:
+        shared += 1
+      _crop(past_key_values, shared)
+    elif self.prefix_cache is not None:
+      (past_key_values, shared) = self.prefix_cache.attach(model, prompt[:-1])
+    generation = self.generation(
+      [prompt[shared:]],
+      processors=processors,
+      num_samples=num_samples,
+      past_key_values=past_key_values if shared > 0 else None,
+      past_length=shared,
+      generator=generator,
+      model=model,
+    )
+    preamble = self.preamble_ids()
+    boundary = len(preamble)
+    if self.prefix_cache is not None and shared < boundary < len(prompt) and prompt[:boundary] == preamble:
+      hidden = _head(generation.cache, boundary)
+      self.prefix_cache.insert(model, preamble, hidden, boundary*_kv_bytes_per_token(model))
+    return generation
+
+  def metered(self, call, prompt, model=None, **kwargs):
+    # `prefilled`, adding the prompt and the prefill time to `call`.
+    if model is None:
+      model = self.model
+    start      = _clock(model.device)
+    generation = self.prefilled(prompt, model=model, **kwargs)
+    call.prompt_tokens   += len(prompt)
+    call.cached_tokens   += generation.past_length
+    call.prefill_seconds += _clock(model.device)-start
+    return generation
+
+  def decode(self, target_ids):
+    return self.tokenizer.decode(target_ids, skip_special_tokens=True)
+
+  def lisp_grammar(self):
+    return LispGrammar.shared(self.tokenizer, self.terminators)
+
+  def __processors(self, constrained):
+    if constrained:
+      return [self.lisp_grammar().processor()]
+    return []
+
+  def generation_key(self, state, seed, constrained=False, model=None):
+    return GenerationCache.key(
+      model=self.model_name,
+      system_prompt=self.system_prompt,
+      state=list(state),
       temperature=self.temperature,
-      eos_token_id=self.terminators,
+      sampling=self.sampling(model),
+      max_new_tokens=self.max_new_tokens,
+      seed=seed,
+      constrained=constrained,
     )
-    target_ids = targets[0][source_ids.shape[-1]:]
-    target     = self.tokenizer.decode(target_ids, skip_special_tokens=True)
+
+  def get(self, state, constrained=False, seed=None):
+    # With `constrained`, sampling is restricted to readable Lisp. With a
+    # `seed`, sampling is reproducible and, if there is a generation cache,
+    # the result is looked up there first.
+    model = self.model
+    key   = None
+    if seed is not None and self.generation_cache is not None:
+      key    = self.generation_key(state, seed, constrained, model)
+      target = self.generation_cache.get(key)
+      if target is not None:
+        return target
+    generator = None
+    if seed is not None:
+      generator = torch.Generator(device=model.device).manual_seed(seed)
+    call       = CallMetrics('get', samples=1)
+    generation = self.metered(
+      call,
+      self.prompt_ids(state),
+      model=model,
+      processors=self.__processors(constrained),
+      generator=generator,
+    )
+    start = _clock(model.device)
+    for _ in range(self.max_new_tokens):
+      (_, token) = generation.step()[0]
+      if token in self.terminators:
+        break
+    target_ids = generation.tokens[0]
+    call.generated_tokens = len(target_ids)
+    call.decode_seconds   = _clock(model.device)-start
+    self.metrics.record(call)
+    target = self.decode(target_ids)
+    if key is not None:
+      self.generation_cache.put(key, target)
     return target
 
-  def reduce(self, input, map, reduce):
+  def stream(self, state, stop=None):
+    # Yields text increments as they are generated. Generation ends when
+    # the consumer stops iterating, or as soon as `stop(text)` is true for
+    # the text so far.
+    # Time spent in the consumer between increments counts as decode time.
+    model       = self.model
+    call        = CallMetrics('stream', samples=1)
+    generation  = self.metered(call, self.prompt_ids(state), model=model)
+    detokenizer = Detokenizer(self.tokenizer)
+    text        = ''
+    start       = _clock(model.device)
+    try:
+      for _ in range(self.max_new_tokens):
+        (_, token) = generation.step()[0]
+        if token in self.terminators:
+          break
+        delta = detokenizer.push(token)
+        if not delta:
+          continue
+        text += delta
+        yield delta
+        if stop is not None and stop(text):
+          break
+    finally:
+      call.generated_tokens = len(generation.tokens[0])
+      call.decode_seconds   = _clock(model.device)-start
+      self.metrics.record(call)
+
+  def reduce(self, input, map, reduce, validator=None, constrained=False):
+    # Self-consistency: sample up to `batch_size` continuations of the same
+    # prompt per round from a single prefill, apply `map` to each as soon
+    # as it terminates, and stop once `purity` of them are valid. Every
+    # continuation started costs one unit of `quota`. With a `validator`
+    # factory (e.g. LispPrefix), each continuation gets its own validator
+    # that is fed text as it is generated, and is aborted the moment the
+    # validator rejects it. Counts for the call are left in `reduce_stats`
+    # and recorded in `metrics`.
+    model   = self.model
     quota   = self.quota
     samples = []
+    stats   = CallMetrics('reduce')
+    prompt  = self.prompt_ids(input)
+    self.reduce_stats = stats
     while quota > 0 and len(samples) < self.purity:
-      quota -= 1
-      samples.clear()
-      try:
-        value = map(self.get(input))
-        samples.append(value)
-      except ValueError:
-        pass
+      count          = min(quota, self.batch_size)
+      quota         -= count
+      stats.samples += count
+      generation     = self.metered(stats, prompt, model=model, num_samples=count, processors=self.__processors(constrained))
+      start          = _clock(model.device)
+      if validator is not None:
+        validators   = [validator() for _ in range(count)]
+        detokenizers = [Detokenizer(self.tokenizer) for _ in range(count)]
+      for _ in range(self.max_new_tokens):
+        if not generation.active or len(samples) >= self.purity:
+          break
+        finished = []
+        aborted  = []
+        for row, token in generation.step():
+          stats.generated_tokens += 1
+          if token in self.terminators:
+            finished.append(row)
+          elif validator is not None and not validators[row](detokenizers[row].push(token)):
+            aborted.append(row)
+        for row in finished:
+          self.__reduce_sample(map, generation.tokens[row], samples, stats)
+        for row in aborted:
+          stats.aborted        += 1
+          stats.aborted_tokens += len(generation.tokens[row])
+        generation.drop(finished+aborted)
+      for row in generation.rows:
+        if len(samples) >= self.purity:
+          break
+        self.__reduce_sample(map, generation.tokens[row], samples, stats)
+      stats.decode_seconds += _clock(model.device)-start
+    self.metrics.record(stats)
     if len(samples) < self.purity and quota == 0:
       raise ValueError(f'Llama.reduce: quota consumed')
-    output = reduce(samples)
+    output = reduce(samples[:self.purity])
     return output
+
+  def __reduce_sample(self, map, target_ids, samples, stats):
+    if len(samples) >= self.purity:
+      return
+    try:
+      samples.append(map(self.decode(target_ids)))
+      stats.valid += 1
+    except ValueError:
+      pass
+
+class Session:
+  # A conversation that keeps the model's past key/values between turns.
+  # Each turn re-renders the chat template, keeps the cached tokens it
+  # shares with the new prompt, and prefills only the rest.
+  llama: 'Llama'
+  state: list[str]
+  tokens: list[int]
+
+  def __init__(self, llama, state=None):
+    self.llama  = llama
+    self.state  = list(state or [])
+    self.tokens = []
+    self.cache  = None
+
+  @property
+  def cache_bytes(self):
+    if self.cache is None:
+      return 0
+    # Measured on the cache itself rather than through `llama.model`, which
+    # could reload a model the registry has since unloaded.
+    return sum(layer.keys.nbytes+layer.values.nbytes for layer in self.cache.layers)
+
+  def evict(self):
+    self.tokens = []
+    self.cache  = None
+
+  def close(self):
+    # Frees the key/values now and removes the session from its store.
+    self.llama.sessions.discard(self)
+    self.evict()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def get(self, message):
+    llama  = self.llama
+    model  = llama.model
+    state  = self.state+[message]
+    prompt = llama.prompt_ids(state)
+    call   = CallMetrics('session', samples=1)
+    generation = llama.metered(
+      call,
+      prompt,
+      model=model,
+      past_key_values=self.cache,
+      past_tokens=self.tokens,
+    )
+    start = _clock(model.device)
+    for _ in range(llama.max_new_tokens):
+      (_, token) = generation.step()[0]
+      if token in llama.terminators:
+        break
+    target_ids  = generation.tokens[0]
+    call.generated_tokens = len(target_ids)
+    call.decode_seconds   = _clock(model.device)-start
+    llama.metrics.record(call)
+    self.cache  = generation.cache
+    self.tokens = (prompt+target_ids)[:self.cache.get_seq_length()]
+    target      = llama.decode(target_ids)
+    self.state  = state+[target]
+    llama.sessions.touch(self)
+    return target
+
+class SessionStore:
+  # Least-recently-used sessions lose their key/values once the total
+  # exceeds `budget` bytes; they keep their messages and re-prefill on
+  # their next turn. Sessions are held by weak reference, so a
+  # conversation the caller has dropped (or closed) leaves the store.
+  budget: int
+
+  def __init__(self, budget):
+    self.budget   = budget
+    self.sessions = collections.OrderedDict()
+
+  def __len__(self):
+    return len(self.sessions)
+
+  @property
+  def total_bytes(self):
+    return sum(session.cache_bytes for session in self.__live())
+
+  def __live(self):
+    return [ref() for ref in list(self.sessions.values()) if ref() is not None]
+
+  def __forget(self, key, ref):
+    if self.sessions.get(key) is ref:
+      del self.sessions[key]
+
+  def touch(self, session):
+    key = id(session)
+    ref = self.sessions.get(key)
+    if ref is None or ref() is not session:
+      ref = weakref.ref(session, lambda ref, key=key: self.__forget(key, ref))
+      self.sessions[key] = ref
+    self.sessions.move_to_end(key)
+    total = self.total_bytes
+    for other in list(self.sessions):
+      if total <= self.budget:
+        break
+      if other == key:
+        continue
+      evicted = self.sessions.pop(other)()
+      if evicted is not None:
+        total -= evicted.cache_bytes
+        evicted.evict()
+
+  def discard(self, session):
+    ref = self.sessions.get(id(session))
+    if ref is not None and ref() is session:
+      del self.sessions[id(session)]
+
+def _settle(future, function, *args):
+  # Resolves a running `future` with `function(*args)`, or with the
+  # exception it raises, so one request cannot fail the rest of its batch.
+  try:
+    result = function(*args)
+  except Exception as err:
+    future.set_exception(err)
+  else:
+    future.set_result(result)
+
+class Server:
+  # Groups concurrent `get` calls into batches. A batch is formed from the
+  # oldest waiting request plus the waiting requests whose prompt lengths
+  # are closest to it, which keeps left padding small. Each request's
+  # future resolves as soon as it emits a terminator, and its row leaves
+  # the batch at that point.
+  llama: Llama
+  max_batch_size: int
+  max_wait: float
+
+  def __init__(self, llama, max_batch_size=16, max_wait=0.01):
+    self.llama          = llama
+    self.max_batch_size = max_batch_size
+    self.max_wait       = max_wait
+    self.requests       = queue.Queue()
+    self.waiting        = []
+    self.closed         = False
+    self.lock           = threading.Lock()
+    self.worker         = threading.Thread(target=self.__run, daemon=True)
+    self.worker.start()
+
+  def submit(self, state):
+    future = concurrent.futures.Future()
+    prompt = self.llama.prompt_ids(state)
+    with self.lock:
+      if self.closed:
+        raise RuntimeError('Server.submit: server is closed')
+      self.requests.put((prompt, future))
+    return future
+
+  def get(self, state):
+    return self.submit(state).result()
+
+  def close(self):
+    with self.lock:
+      if self.closed:
+        return
+      self.closed = True
+      self.requests.put(None)
+    self.worker.join()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def __collect(self):
+    if not self.waiting:
+      request = self.requests.get()
+      if request is None:
+        return False
+      self.waiting.append(request)
+    deadline = time.monotonic()+self.max_wait
+    while len(self.waiting) < self.max_batch_size:
+      timeout = deadline-time.monotonic()
+      if timeout <= 0:
+        break
+      try:
+        request = self.requests.get(timeout=timeout)
+      except queue.Empty:
+        break
+      if request is None:
+        self.closed = True
+        break
+      self.waiting.append(request)
+    return True
+
+  def __batch(self):
+    # Requests whose futures were cancelled while waiting are dropped; the
+    # ones taken into the batch are marked running, so they can no longer
+    # be cancelled.
+    self.waiting = [request for request in self.waiting if not request[1].cancelled()]
+    if not self.waiting:
+      return []
+    (oldest, *rest) = self.waiting
+    length = len(oldest[0])
+    rest   = sorted(rest, key=lambda request: abs(len(request[0])-length))
+    batch  = [oldest]+rest[:self.max_batch_size-1]
+    chosen = set(map(id, batch))
+    self.waiting = [request for request in self.waiting if id(request) not in chosen]
+    return [request for request in batch if request[1].set_running_or_notify_cancel()]
+
+  def __run(self):
+    while self.__collect() or self.waiting:
+      batch = self.__batch() if self.waiting else []
+      if batch:
+        try:
+          self.__generate(batch)
+        except Exception as err:
+          for _, future in batch:
+            if not future.done():
+              future.set_exception(err)
+      if self.closed and self.requests.empty() and not self.waiting:
+        break
+
+  def __generate(self, batch):
+    llama      = self.llama
+    futures    = [future for _, future in batch]
+    generation = llama.generation([prompt for prompt, _ in batch])
+    for _ in range(llama.max_new_tokens):
+      if not generation.active:
+        break
+      finished = [row for row, token in generation.step() if token in llama.terminators]
+      for row in finished:
+        _settle(futures[row], llama.decode, generation.tokens[row])
+      generation.drop(finished)
+    for row in generation.rows:
+      _settle(futures[row], llama.decode, generation.tokens[row])
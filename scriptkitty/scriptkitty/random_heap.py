@@ -0,0 +1,359 @@
+import time
+import heapq
+import random
+
+import numpy
+
+# Randomized meldable heap (Gambin & Malinowski). Meld walks a random
+# root-to-leaf path of the smaller root, so insert, pop and meld are all
+# expected O(log n) with no balancing metadata.
+
+class _Node:
+  __slots__ = ('key', 'value', 'left', 'right')
+
+  def __init__(self, key, value, left=None, right=None):
+    self.key   = key
+    self.value = value
+    self.left  = left
+    self.right = right
+
+class Heap:
+  root: _Node | None
+  size: int
+  rng: random.Random
+
+  def __init__(self, seed=None):
+    self.root = None
+    self.size = 0
+    self.rng  = random.Random(seed)
+
+  @staticmethod
+  def from_list(items, seed=None):
+    # Bulk heapify by melding pairs of heaps in rounds; each round halves
+    # the number of heaps so the total work is O(n).
+    heap  = Heap(seed)
+    queue = [_Node(key, value) for key, value in items]
+    heap.size = len(queue)
+    while len(queue) > 1:
+      buf = []
+      for i in range(0, len(queue)-1, 2):
+        buf.append(heap.__meld(queue[i], queue[i+1]))
+      if len(queue)%2 == 1:
+        buf.append(queue[-1])
+      queue = buf
+    if queue:
+      heap.root = queue[0]
+    return heap
+
+  def __len__(self):
+    return self.size
+
+  def __bool__(self):
+    return self.size > 0
+
+  def push(self, key, value=None):
+    self.root  = self.__meld(self.root, _Node(key, value))
+    self.size += 1
+
+  def peek(self):
+    if self.root is None:
+      raise IndexError('Heap.peek: empty heap')
+    return self.root.key, self.root.value
+
+  def pop(self):
+    if self.root is None:
+      raise IndexError('Heap.pop: empty heap')
+    root       = self.root
+    self.root  = self.__meld(root.left, root.right)
+    self.size -= 1
+    return root.key, root.value
+
+  def pushpop(self, key, value=None):
+    if self.root is None or key <= self.root.key:
+      return key, value
+    output = self.pop()
+    self.push(key, value)
+    return output
+
+  def meld(self, other):
+    # Destructive: `other` is emptied and its nodes move into `self`.
+    if other is self:
+      raise ValueError('Heap.meld: cannot meld a heap with itself')
+    self.root   = self.__meld(self.root, other.root)
+    self.size  += other.size
+    other.root  = None
+    other.size  = 0
+    return self
+
+  def drain(self):
+    while self.root is not None:
+      yield self.pop()
+
+  def __meld(self, lhs, rhs):
+    if lhs is None:
+      return rhs
+    if rhs is None:
+      return lhs
+    if rhs.key < lhs.key:
+      lhs, rhs = rhs, lhs
+    root = lhs
+    bits = self.rng.getrandbits
+    while True:
+      if bits(1):
+        child = lhs.left
+        if child is None:
+          lhs.left = rhs
+          return root
+        if rhs.key < child.key:
+          lhs.left   = rhs
+          lhs, rhs   = rhs, child
+        else:
+          lhs = child
+      else:
+        child = lhs.right
+        if child is None:
+          lhs.right = rhs
+          return root
+        if rhs.key < child.key:
+          lhs.right  = rhs
+          lhs, rhs   = rhs, child
+        else:
+          lhs = child
+
+class ArrayHeap:
+  # Same algorithm over parallel arrays, for numeric keys. Nodes are indices
+  # and -1 is the empty child, so heaps of millions of entries cost a few
+  # machine words per node instead of a Python object each. Push and pop
+  # are expected O(log n), but each heap owns its arrays, so `meld` first
+  # copies the other heap's nodes in: O(size of other) vectorized work plus
+  # the expected O(log n) root meld.
+  keys: numpy.ndarray
+  values: numpy.ndarray
+  left: numpy.ndarray
+  right: numpy.ndarray
+  root: int
+  size: int
+  rng: random.Random
+
+  def __init__(self, capacity=16, dtype=numpy.float64, seed=None):
+    capacity    = max(1, capacity)
+    self.keys   = numpy.empty(capacity, dtype=dtype)
+    self.values = numpy.empty(capacity, dtype=numpy.int64)
+    self.left   = numpy.full(capacity, -1, dtype=numpy.int64)
+    self.right  = numpy.full(capacity, -1, dtype=numpy.int64)
+    self.free   = []
+    self.used   = 0
+    self.root   = -1
+    self.size   = 0
+    self.rng    = random.Random(seed)
+
+  @staticmethod
+  def from_array(keys, values=None, seed=None):
+    # A sorted array is heap-ordered under the implicit layout where node i
+    # has children 2i+1 and 2i+2, so bulk heapify is one vectorized sort.
+    keys  = numpy.asarray(keys)
+    count = len(keys)
+    if values is None:
+      values = numpy.arange(count, dtype=numpy.int64)
+    order = numpy.argsort(keys, kind='stable')
+    heap  = ArrayHeap(count, keys.dtype, seed)
+    index = numpy.arange(count, dtype=numpy.int64)
+    lhs   = 2*index+1
+    rhs   = 2*index+2
+    heap.keys[:count]   = keys[order]
+    heap.values[:count] = numpy.asarray(values, dtype=numpy.int64)[order]
+    heap.left[:count]   = numpy.where(lhs < count, lhs, -1)
+    heap.right[:count]  = numpy.where(rhs < count, rhs, -1)
+    heap.used = count
+    heap.size = count
+    heap.root = 0 if count > 0 else -1
+    return heap
+
+  def __len__(self):
+    return self.size
+
+  def __bool__(self):
+    return self.size > 0
+
+  def push(self, key, value=-1):
+    node = self.__alloc(key, value)
+    self.root  = self.__meld(self.root, node)
+    self.size += 1
+
+  def peek(self):
+    if self.root < 0:
+      raise IndexError('ArrayHeap.peek: empty heap')
+    return self.keys[self.root].item(), self.values[self.root].item()
+
+  def pop(self):
+    if self.root < 0:
+      raise IndexError('ArrayHeap.pop: empty heap')
+    root   = self.root
+    output = (self.keys[root].item(), self.values[root].item())
+    self.root  = self.__meld(int(self.left[root]), int(self.right[root]))
+    self.size -= 1
+    self.free.append(root)
+    return output
+
+  def meld(self, other):
+    # Copies `other` into this heap's arrays with its node indices shifted,
+    # then melds the two roots; `other` is emptied.
+    if other is self:
+      raise ValueError('ArrayHeap.meld: cannot meld a heap with itself')
+    if other.size == 0:
+      return self
+    count  = other.used
+    offset = self.used
+    self.__reserve(offset+count)
+    lhs = other.left[:count]
+    rhs = other.right[:count]
+    self.keys[offset:offset+count]   = other.keys[:count]
+    self.values[offset:offset+count] = other.values[:count]
+    self.left[offset:offset+count]   = numpy.where(lhs < 0, -1, lhs+offset)
+    self.right[offset:offset+count]  = numpy.where(rhs < 0, -1, rhs+offset)
+    self.free.extend(index+offset for index in other.free)
+    self.used  += count
+    self.root   = self.__meld(self.root, other.root+offset)
+    self.size  += other.size
+    other.free.clear()
+    other.used = 0
+    other.root = -1
+    other.size = 0
+    return self
+
+  def drain(self):
+    while self.root >= 0:
+      yield self.pop()
+
+  def __reserve(self, capacity):
+    if capacity <= len(self.keys):
+      return
+    capacity    = max(capacity, 2*len(self.keys))
+    grow        = capacity-len(self.keys)
+    self.keys   = numpy.concatenate([self.keys, numpy.empty(grow, dtype=self.keys.dtype)])
+    self.values = numpy.concatenate([self.values, numpy.empty(grow, dtype=numpy.int64)])
+    self.left   = numpy.concatenate([self.left, numpy.full(grow, -1, dtype=numpy.int64)])
+    self.right  = numpy.concatenate([self.right, numpy.full(grow, -1, dtype=numpy.int64)])
+
+  def __alloc(self, key, value):
+    if self.free:
+      node = self.free.pop()
+    else:
+      self.__reserve(self.used+1)
+      node       = self.used
+      self.used += 1
+    self.keys[node]   = key
+    self.values[node] = value
+    self.left[node]   = -1
+    self.right[node]  = -1
+    return node
+
+  def __meld(self, lhs, rhs):
+    if lhs < 0:
+      return rhs
+    if rhs < 0:
+      return lhs
+    keys  = self.keys
+    left  = self.left
+    right = self.right
+    if keys[rhs] < keys[lhs]:
+      lhs, rhs = rhs, lhs
+    root = lhs
+    bits = self.rng.getrandbits
+    while True:
+      side  = left if bits(1) else right
+      child = int(side[lhs])
+      if child < 0:
+        side[lhs] = rhs
+        return root
+      if keys[rhs] < keys[child]:
+        side[lhs] = rhs
+        lhs, rhs  = rhs, child
+      else:
+        lhs = child
+
+def smallest(k, items, key=None, seed=None):
+  # Top-k selection: heapify once in O(n), then pop k times in O(k log n).
+  if key is None:
+    heap = Heap.from_list(((item, item) for item in items), seed)
+  else:
+    heap = Heap.from_list(((key(item), item) for item in items), seed)
+  output = []
+  while heap and len(output) < k:
+    output.append(heap.pop()[1])
+  return output
+
+def benchmark(size=100_000, seed=0):
+  rng  = random.Random(seed)
+  keys = [rng.random() for _ in range(size)]
+  report = {}
+
+  def timed(name, fn):
+    start = time.perf_counter()
+    fn()
+    report[name] = time.perf_counter()-start
+
+  def heapq_push_pop():
+    heap = []
+    for key in keys:
+      heapq.heappush(heap, key)
+    while heap:
+      heapq.heappop(heap)
+
+  def heapq_heapify():
+    heapq.heapify(list(keys))
+
+  def heapq_meld():
+    lhs = list(keys)
+    rhs = list(keys)
+    heapq.heapify(lhs)
+    heapq.heapify(rhs)
+    start = time.perf_counter()
+    lhs  += rhs
+    heapq.heapify(lhs)
+    report['heapq.meld.only'] = time.perf_counter()-start
+
+  def heap_push_pop():
+    heap = Heap(seed)
+    for key in keys:
+      heap.push(key)
+    while heap:
+      heap.pop()
+
+  def heap_heapify():
+    Heap.from_list((key, None) for key in keys)
+
+  def heap_meld():
+    lhs   = Heap.from_list(((key, None) for key in keys), seed)
+    rhs   = Heap.from_list(((key, None) for key in keys), seed)
+    start = time.perf_counter()
+    lhs.meld(rhs)
+    report['Heap.meld.only'] = time.perf_counter()-start
+
+  def array_push_pop():
+    heap = ArrayHeap(size, seed=seed)
+    for index, key in enumerate(keys):
+      heap.push(key, index)
+    while heap:
+      heap.pop()
+
+  def array_heapify():
+    ArrayHeap.from_array(numpy.asarray(keys), seed=seed)
+
+  def array_meld():
+    lhs   = ArrayHeap.from_array(numpy.asarray(keys), seed=seed)
+    rhs   = ArrayHeap.from_array(numpy.asarray(keys), seed=seed)
+    start = time.perf_counter()
+    lhs.meld(rhs)
+    report['ArrayHeap.meld.only'] = time.perf_counter()-start
+
+  timed('heapq.push_pop', heapq_push_pop)
+  timed('heapq.heapify', heapq_heapify)
+  timed('heapq.meld', heapq_meld)
+  timed('Heap.push_pop', heap_push_pop)
+  timed('Heap.heapify', heap_heapify)
+  timed('Heap.meld', heap_meld)
+  timed('ArrayHeap.push_pop', array_push_pop)
+  timed('ArrayHeap.heapify', array_heapify)
+  timed('ArrayHeap.meld', array_meld)
+  return report
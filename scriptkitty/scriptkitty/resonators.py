@@ -1,6 +1,138 @@
+from typing import Optional
+
+import os
+import json
+import time
 import numpy
+import pickle
+import random
+import hashlib
+import collections
 import scipy
+import functools
 import dataclasses
+import multiprocessing.shared_memory
+
+@dataclasses.dataclass(frozen=True)
+class Batched:
+  body: callable
+
+  @property
+  def is_batched(self):
+    return True
+
+  def __call__(self, states):
+    return numpy.asarray(self.body(states))
+
+def batched(body):
+  return Batched(body)
+
+def is_batched(component):
+  return getattr(component, 'is_batched', False)
+
+def state_key(state):
+  # Content key for deduplicating states. Lisp values are frozen
+  # dataclasses, so their own hash and equality are already structural.
+  # Unhashable states (dicts, sets, mutable dataclasses) are keyed by
+  # identity, so they are only merged with themselves; Population keeps a
+  # reference to each, so the id cannot be reused while it is in use.
+  match state:
+    case numpy.ndarray():
+      return (state.dtype.str, state.shape, state.tobytes())
+    case list() | tuple():
+      return (type(state).__name__, *map(state_key, state))
+    case _:
+      try:
+        hash(state)
+      except TypeError:
+        return ('identity', id(state))
+      return state
+
+class Population:
+  # A multiset of states: each distinct state is stored once, in order of
+  # first appearance, with its multiplicity. `order` keeps the index of
+  # every state as it was added, so the population still reads back in
+  # the order it was drawn in.
+  states: list
+  counts: list[int]
+  order: list[int]
+
+  def __init__(self, states=()):
+    self.states     = []
+    self.counts     = []
+    self.order      = []
+    self.index      = {}
+    self.cumulative = None
+    for state in states:
+      self.add(state)
+
+  def __len__(self):
+    return sum(self.counts)
+
+  @property
+  def unique(self):
+    return len(self.states)
+
+  def add(self, state, count=1):
+    key = state_key(state)
+    if key in self.index:
+      self.counts[self.index[key]] += count
+    else:
+      self.index[key] = len(self.states)
+      self.states.append(state)
+      self.counts.append(count)
+    self.order     += [self.index[key]]*count
+    self.cumulative = None
+
+  def choice(self, rng):
+    # Same distribution as a uniform choice from `expand()`.
+    if self.cumulative is None:
+      self.cumulative = numpy.cumsum(self.counts)
+    point = rng.integers(self.cumulative[-1])
+    return self.states[numpy.searchsorted(self.cumulative, point, side='right')]
+
+  def expand(self):
+    return [self.states[index] for index in self.order]
+
+class FitnessCache:
+  # Results of each fitness predicate over the current layer's population,
+  # by fitness id and state index. The selection is the first `bottleneck`
+  # passing states of the population in `order`, a Population's draw order
+  # of indices into the distinct `states`, so it is the same as walking
+  # the expanded list; duplicates are still only tested once. Per-state
+  # predicates are only run as far into the order as some slot has needed;
+  # batched predicates fill their whole mask with one call.
+  states: list
+  order: list[int]
+  results: dict[int, list[Optional[bool]]]
+
+  def __init__(self, states, order=None):
+    self.states  = states
+    self.order   = range(len(states)) if order is None else order
+    self.results = {}
+
+  def select(self, fitness_id, fitness, bottleneck):
+    if fitness_id not in self.results:
+      self.results[fitness_id] = [None]*len(self.states)
+    results = self.results[fitness_id]
+    if is_batched(fitness) and None in results:
+      results[:] = fitness(self.states).astype(bool).tolist()
+    selected = []
+    for index in self.order:
+      if results[index] is None:
+        results[index] = bool(fitness(self.states[index]))
+      if results[index]:
+        selected.append(self.states[index])
+        if len(selected) >= bottleneck:
+          return selected
+    return None
+
+  def summary(self):
+    buf = []
+    for fitness_id, results in sorted(self.results.items()):
+      tested = [result for result in results if result is not None]
+      buf.append(f'{fitness_id}:{sum(tested)}/{len(tested)}')
+    return ' '.join(buf)
 
 class Decoder:
   fitness: list[callable]
@@ -9,6 +141,8 @@ class Decoder:
   weights: numpy.ndarray
   state_capacity: int
   state_bottleneck: int
+  log: Optional[callable]
+  rng: numpy.random.Generator
 
   def __init__(
     self,
@@ -18,13 +152,16 @@ class Decoder:
     weights: numpy.ndarray,
     state_capacity: int,
     state_bottleneck: int,
+    log: Optional[callable] = None,
   ):
-    self.fitness          = fitness
-    self.crossover        = crossover
-    self.mutation         = mutation
-    self.weights          = weights
-    self.state_capacity   = state_capacity
-    self.state_bottleneck = state_bottleneck
+    self.fitness           = fitness
+    self.crossover         = crossover
+    self.mutation          = mutation
+    self.weights           = weights
+    self.state_capacity    = state_capacity
+    self.state_bottleneck  = state_bottleneck
+    self.log               = log
+    self.rng               = numpy.random.default_rng()
 
     assert len(weights) == self.layers*self.weights_per_layer
 
@@ -60,17 +197,30 @@ class Decoder:
     return self.weights[lhs:lhs+self.fitness_weights_per_layer]
 
   def crossover_weights(self, layer, fitness):
-    lhs = layer*self.weights_per_layer+self.fitness_weights_per_layer
-    return self.weights[lhs:lhs+self.crossover_weights_per_layer]
+    lhs  = layer*self.weights_per_layer+self.fitness_weights_per_layer
+    lhs += fitness*len(self.crossover)
+    return self.weights[lhs:lhs+len(self.crossover)]
 
   def mutation_weights(self, layer, fitness, crossover):
-    lhs = layer*self.weights_per_layer+self.fitness_weights_per_layer+self.crossover_weights_per_layer
-    return self.weights[lhs:lhs+self.mutation_weights_per_layer]
+    lhs  = layer*self.weights_per_layer+self.fitness_weights_per_layer+self.crossover_weights_per_layer
+    lhs += (fitness*len(self.crossover)+crossover)*len(self.mutation)
+    return self.weights[lhs:lhs+len(self.mutation)]
 
   def residual_weights(self, layer):
-    lhs = layer*self.weights_per_layer+self.fitness_weights_per_layer+self.crossover_weights_per_layer+1
+    lhs = layer*self.weights_per_layer+self.fitness_weights_per_layer+self.crossover_weights_per_layer+self.mutation_weights_per_layer
     return self.weights[lhs]
 
+  def compile(self):
+    return CompiledDecoder(
+      self.fitness,
+      self.crossover,
+      self.mutation,
+      self.weights,
+      self.state_capacity,
+      self.state_bottleneck,
+      self.log,
+    )
+
   def race(self, components, weights):
     sorted_components = numpy.random.choice(
       components,
@@ -80,98 +230,433 @@ class Decoder:
     )
     return sorted_components
 
+  def race_batch(self, key, weights, size, rng=None):
+    # Gumbel top-k: perturbing log-probabilities with independent Gumbel
+    # noise and sorting gives exactly the distribution of sequential
+    # sampling without replacement, i.e. `race`, for `size` rows at once.
+    # Rows are orderings of component indices rather than components.
+    # The softmax is taken from `weights` on every call, so changes to
+    # `self.weights` apply immediately; `key` only matters to
+    # CompiledDecoder, whose weights are frozen.
+    rng               = rng or self.rng
+    log_probabilities = scipy.special.log_softmax(weights)
+    gumbel            = rng.gumbel(size=(size, len(log_probabilities)))
+    return numpy.argsort(-(log_probabilities+gumbel), axis=1)
+
   def __softmax(self, array):
     return scipy.special.softmax(array)
 
-  def __coin(self, weight):
-    return numpy.random.random() < weight
+  def __log(self, message):
+    if self.log is not None:
+      self.log(message)
 
-  def __choice(self, components):
-    return numpy.random.choice(components)
+  def __coin(self, weight, rng):
+    return rng.random() < weight
 
-  def __call__(self, states):
-    for layer in range(self.layers):
-      hidden_states = []
-      for i in range(self.state_capacity):
-        sorted_fitness = self.race(
-          self.fitness,
-          self.fitness_weights(layer),
-        )
-        fitness_hidden      = []
-        current_fitness_id  = 0
-        selected_fitness_id = None
-        while selected_fitness_id is None and current_fitness_id < len(self.fitness):
-          local_fitness = sorted_fitness[current_fitness_id]
-          fitness_hidden.clear()
-          for state in states:
-            if local_fitness(state):
-              print(f'Decoder current_fitness_id {current_fitness_id} {state} True')
-              fitness_hidden.append(state)
-              if len(fitness_hidden) >= self.state_bottleneck:
-                selected_fitness_id = current_fitness_id
-                break
-            else:
-              print(f'Decoder current_fitness_id {current_fitness_id} {state} False')
-          current_fitness_id += 1
-        if selected_fitness_id is None:
-          raise ValueError(f'No fitness operation available')
-        assert len(fitness_hidden) == self.state_botteneck
-        print(f'Decoder.fitness_hidden = {fitness_hidden} Ok')
-        sorted_crossover = self.race(
-          self.crossover,
-          self.crossover_weights(layer, selected_fitness_id),
-        )
-        crossover_hidden      = None
-        current_crossover_id  = 0
-        selected_crossover_id = None
-        while selected_crossover_id is None and current_crossover_id < len(self.crossover):
-          local_crossover = sorted_crossover[current_crossover_id]
-          try:
-            crossover_hidden      = functools.reduce(local_crossover, fitness_hidden)
-            selected_crossover_id = current_crossover_id
-          except ValueError as err:
-            print(f'Decoder.current_crossover_id {current_crossover_id} Err')
-            current_crossover_id += 1
-        if selected_crossover_id is None:
-          raise ValueError('No crossover operation available')
-        assert crossover_hidden is not None
-        print(f'Decoder.crossover_hidden = {crossover_hidden} Ok')
-        sorted_mutation = self.race(
-          self.mutation,
-          self.mutation_weights(layer, selected_fitness_id, selected_crossover_id)
+  def layer_slots(self, layer, states, slots, rng, order=None):
+    hidden_states = []
+    orders        = {}
+    fitness_cache = FitnessCache(states, order)
+
+    def order(key, weights, slot):
+      if key not in orders:
+        orders[key] = self.race_batch(key, weights, len(slots), rng)
+      return orders[key][slot]
+
+    for i in range(len(slots)):
+      sorted_fitness = order(
+        ('fitness', layer),
+        self.fitness_weights(layer),
+        i,
+      )
+      fitness_hidden      = None
+      selected_fitness_id = None
+      for current_fitness_id in sorted_fitness:
+        fitness_hidden = fitness_cache.select(
+          current_fitness_id,
+          self.fitness[current_fitness_id],
+          self.state_bottleneck,
         )
-        mutation_hidden      = []
-        current_mutation_id  = 0
-        selected_mutation_id = None
-        while selected_mutation_id is None and current_mutation_id < len(self.mutation):
-          local_mutation = sorted_mutation[current_mutation_id]
-          try:
-            mutation_hidden.clear()
-            for j in range(self.state_bottleneck):
-              point = local_mutation(crossover_hidden)
-              mutation_hidden.append(point)
-            selected_mutation_id = current_mutation_id
-          except ValueError as err:
-            print(f'Decoder.current_mutation_id {current_mutation_id} Err')
-            current_mutation_id += 1
-        if selected_mutation_id is None:
-          raise ValueError('No mutation operator available')
-        assert len(mutation_hidden) == self.state_bottleneck
-        print(f'Decoder.mutation_hidden {mutation_hidden}')
-        hidden_states += mutation_hidden
-      target_states = []
-      residual      = self.residual_weights(layer)
+        if fitness_hidden is not None:
+          selected_fitness_id = current_fitness_id
+          break
+      if selected_fitness_id is None:
+        raise ValueError(f'No fitness operation available')
+      assert len(fitness_hidden) == self.state_bottleneck
+      sorted_crossover = order(
+        ('crossover', layer, selected_fitness_id),
+        self.crossover_weights(layer, selected_fitness_id),
+        i,
+      )
+      crossover_hidden      = None
+      selected_crossover_id = None
+      for current_crossover_id in sorted_crossover:
+        local_crossover = self.crossover[current_crossover_id]
+        try:
+          crossover_hidden      = functools.reduce(local_crossover, fitness_hidden)
+          selected_crossover_id = current_crossover_id
+          break
+        except ValueError as err:
+          self.__log(f'Decoder.current_crossover_id {current_crossover_id} Err')
+      if selected_crossover_id is None:
+        raise ValueError('No crossover operation available')
+      assert crossover_hidden is not None
+      sorted_mutation = order(
+        ('mutation', layer, selected_fitness_id, selected_crossover_id),
+        self.mutation_weights(layer, selected_fitness_id, selected_crossover_id),
+        i,
+      )
+      mutation_hidden      = []
+      selected_mutation_id = None
+      for current_mutation_id in sorted_mutation:
+        local_mutation = self.mutation[current_mutation_id]
+        try:
+          mutation_hidden.clear()
+          for j in range(self.state_bottleneck):
+            point = local_mutation(crossover_hidden)
+            mutation_hidden.append(point)
+          selected_mutation_id = current_mutation_id
+          break
+        except ValueError as err:
+          self.__log(f'Decoder.current_mutation_id {current_mutation_id} Err')
+      if selected_mutation_id is None:
+        raise ValueError('No mutation operator available')
+      assert len(mutation_hidden) == self.state_bottleneck
+      hidden_states += mutation_hidden
+    self.__log(f'Decoder layer {layer} slots {slots.start}:{slots.stop} fitness {fitness_cache.summary()}')
+    return hidden_states
+
+  def __parallel_layer_slots(self, layer, states, order, executor, rng, slots_per_task):
+    # Every task gets its own SeedSequence child, which seeds both its
+    # Generator and the global `random`/`numpy.random` state that
+    # crossover and mutation operators draw from, so with a process pool
+    # the output depends on the seed and `slots_per_task` but not on the
+    # number of workers or the order in which tasks finish. The decoder
+    # and the layer's population are pickled once into shared memory and
+    # each worker unpickles them once per layer; tasks carry only the
+    # block's name and their slots.
+    payload = pickle.dumps((self, states, order))
+    shared  = multiprocessing.shared_memory.SharedMemory(create=True, size=max(1, len(payload)))
+    try:
+      shared.buf[:len(payload)] = payload
+      tasks   = []
+      streams = numpy.random.SeedSequence(rng.integers(2**63))
+      chunks  = range(0, self.state_capacity, slots_per_task)
+      for start, seed in zip(chunks, streams.spawn(len(chunks))):
+        slots = range(start, min(start+slots_per_task, self.state_capacity))
+        tasks.append(executor.submit(_decoder_layer_slots, shared.name, len(payload), layer, slots, seed))
+      hidden_states = []
+      for task in tasks:
+        hidden_states += task.result()
+    finally:
+      shared.close()
+      shared.unlink()
+    return hidden_states
+
+  def __call__(self, states, executor=None, seed=None, slots_per_task=16):
+    # With an `executor` (e.g. concurrent.futures.ProcessPoolExecutor) the
+    # slots of each layer are fanned out across workers; the decoder and
+    # its components must then be picklable. Thread pools share the global
+    # `random`/`numpy.random` state, so only process pools are reproducible
+    # for operators that draw from it. Between layers the population
+    # is kept as a Population, so fitness only tests distinct states.
+    if seed is None:
+      rng = self.rng
+    else:
+      rng = numpy.random.default_rng(seed)
+    population = Population(states)
+    for layer in range(self.layers):
+      states = population.states
+      order  = population.order
+      if executor is None:
+        hidden_states = self.layer_slots(layer, states, range(self.state_capacity), rng, order)
+      else:
+        hidden_states = self.__parallel_layer_slots(layer, states, order, executor, rng, slots_per_task)
+      hidden_population = Population(hidden_states)
+      target_population = Population()
+      residual          = self.residual_weights(layer)
       for i in range(self.state_capacity):
-        if self.__coin() < residual:
-          state = self.__choice(states)
-          print(f'Decoder residual state {state}')
+        if self.__coin(residual, rng):
+          state = population.choice(rng)
         else:
-          state = self.__choice(hidden_states)
-          print(f'Decoder hidden state {state}')
-        target_states.append(state)
-      print(f'Decoder.target_states {target_states}')
-      states = target_states
-    return states
+          state = hidden_population.choice(rng)
+        target_population.add(state)
+      population = target_population
+    return population.expand()
+
+class CompiledDecoder(Decoder):
+  # A Decoder whose weights are frozen at construction. Every per-layer,
+  # per-condition weight slice is a view into one reshaped copy of the
+  # weights, and its log-softmax is precomputed into a table of the same
+  # shape, so the race in each slot is an index into an array rather than a
+  # chain of offset computations and a softmax.
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    fitl   = len(self.fitness)
+    crossl = len(self.crossover)
+    mutl   = len(self.mutation)
+    layers = self.layers
+    table  = numpy.array(self.weights, dtype=numpy.float64).reshape(layers, self.weights_per_layer)
+    table.setflags(write=False)
+    self.weights = table.reshape(-1)
+    lhs = fitl
+    rhs = lhs+fitl*crossl
+    self.fitness_table   = table[:, :fitl]
+    self.crossover_table = table[:, lhs:rhs].reshape(layers, fitl, crossl)
+    self.mutation_table  = table[:, rhs:rhs+fitl*crossl*mutl].reshape(layers, fitl, crossl, mutl)
+    self.residual_table  = table[:, -1]
+    self.log_probability_tables = {
+      'fitness': self.__log_softmax(self.fitness_table),
+      'crossover': self.__log_softmax(self.crossover_table),
+      'mutation': self.__log_softmax(self.mutation_table),
+    }
+
+  def __log_softmax(self, table):
+    if table.shape[-1] == 0:
+      return table
+    hidden = numpy.ascontiguousarray(scipy.special.log_softmax(table, axis=-1))
+    hidden.setflags(write=False)
+    return hidden
+
+  def compile(self):
+    return self
+
+  def fitness_weights(self, layer):
+    return self.fitness_table[layer]
+
+  def crossover_weights(self, layer, fitness):
+    return self.crossover_table[layer, fitness]
+
+  def mutation_weights(self, layer, fitness, crossover):
+    return self.mutation_table[layer, fitness, crossover]
+
+  def residual_weights(self, layer):
+    return self.residual_table[layer]
+
+  def race_batch(self, key, weights, size, rng=None):
+    rng               = rng or self.rng
+    log_probabilities = self.log_probability_tables[key[0]][key[1:]]
+    gumbel            = rng.gumbel(size=(size, len(log_probabilities)))
+    return numpy.argsort(-(log_probabilities+gumbel), axis=1)
+
+# The most recent (decoder, states, order) unpickled in this process, by
+# shared memory block name, so a worker reads each layer's payload once.
+_decoder_payload = (None, None)
+
+def _decoder_layer_slots(name, size, layer, slots, seed):
+  global _decoder_payload
+  if _decoder_payload[0] != name:
+    shared = multiprocessing.shared_memory.SharedMemory(name=name)
+    try:
+      _decoder_payload = (name, pickle.loads(shared.buf[:size]))
+    finally:
+      shared.close()
+  (decoder, states, order) = _decoder_payload[1]
+  (python_seed, numpy_seed) = seed.generate_state(2)
+  random.seed(int(python_seed))
+  numpy.random.seed(int(numpy_seed))
+  rng = numpy.random.default_rng(seed)
+  return decoder.layer_slots(layer, states, slots, rng, order)
+
+def benchmark_race(num_components=16, state_capacity=256, repeat=10):
+  components = [lambda state: state]*num_components
+  weights    = numpy.random.normal(size=num_components)
+  decoder    = Decoder(components, [], [], numpy.zeros(num_components+1), state_capacity, 1)
+  report     = {}
+  start = time.perf_counter()
+  for _ in range(repeat):
+    for _ in range(state_capacity):
+      decoder.race(components, weights)
+  report['race'] = (time.perf_counter()-start)/repeat
+  start = time.perf_counter()
+  for _ in range(repeat):
+    decoder.race_batch('benchmark', weights, state_capacity)
+  report['race_batch'] = (time.perf_counter()-start)/repeat
+  return report
+
+@dataclasses.dataclass(eq=False)
+class Swarm:
+  # All particles as rows of one matrix, with momentum and energy as
+  # parallel arrays. The scratch buffers are allocated once and reused by
+  # Optimizer.step so that an iteration allocates nothing per particle.
+  weights: numpy.ndarray
+  momentum: numpy.ndarray
+  energy: numpy.ndarray
+  rng: numpy.random.Generator
+  position: int = 0
+  average: numpy.ndarray = dataclasses.field(init=False, repr=False)
+  compass: numpy.ndarray = dataclasses.field(init=False, repr=False)
+  residual: numpy.ndarray = dataclasses.field(init=False, repr=False)
+  noise: numpy.ndarray = dataclasses.field(init=False, repr=False)
+  scale: numpy.ndarray = dataclasses.field(init=False, repr=False)
+  active: numpy.ndarray = dataclasses.field(init=False, repr=False)
+
+  def __post_init__(self):
+    (state_capacity, num_weights) = self.weights.shape
+    self.average  = numpy.empty(num_weights)
+    self.compass  = numpy.empty((state_capacity, num_weights))
+    self.residual = numpy.empty((state_capacity, num_weights))
+    self.noise    = numpy.empty((state_capacity, num_weights))
+    self.scale    = numpy.empty((state_capacity, 1))
+    self.active   = numpy.empty((state_capacity, 1))
+
+  @staticmethod
+  def initial(initial_weights, state_capacity, noise_factor, rng):
+    initial_weights = numpy.asarray(initial_weights, dtype=numpy.float64)
+    if initial_weights.ndim == 1:
+      noise   = rng.standard_normal((state_capacity, len(initial_weights)))
+      weights = initial_weights+noise*noise_factor
+    else:
+      assert initial_weights.shape[0] == state_capacity
+      weights = initial_weights.copy()
+    momentum = numpy.zeros_like(weights)
+    energy   = numpy.zeros(state_capacity)
+    return Swarm(weights, momentum, energy, rng)
+
+  @property
+  def state_capacity(self):
+    return self.weights.shape[0]
+
+  @property
+  def num_weights(self):
+    return self.weights.shape[1]
+
+class Checkpoint:
+  # Swarm state in a memory-mapped array of shape (2, state_capacity,
+  # 2*num_weights+1) holding [weights | momentum | energy] per particle, plus
+  # a small JSON file with the quota position and generator state. Saves
+  # alternate between the two slots and the JSON file is replaced
+  # atomically after the slot is flushed, so a crash mid-write leaves the
+  # previous checkpoint intact.
+  path: str
+  every: int
+
+  def __init__(self, path, every=1):
+    self.path  = path
+    self.every = every
+    self.table = None
+    self.slot  = 0
+
+  @property
+  def table_path(self):
+    return os.path.join(self.path, 'swarm.npy')
+
+  @property
+  def state_path(self):
+    return os.path.join(self.path, 'state.json')
+
+  @property
+  def exists(self):
+    return os.path.exists(self.state_path)
+
+  def __open(self, shape):
+    if self.table is not None:
+      return self.table
+    if os.path.exists(self.table_path):
+      table = numpy.load(self.table_path, mmap_mode='r+')
+      if table.shape != shape:
+        raise ValueError(f'Checkpoint: expected shape {shape}, but got {table.shape}')
+    else:
+      os.makedirs(self.path, exist_ok=True)
+      table = numpy.lib.format.open_memmap(
+        self.table_path,
+        mode='w+',
+        dtype=numpy.float64,
+        shape=shape,
+      )
+    self.table = table
+    return table
+
+  def save(self, swarm):
+    if swarm.position%self.every != 0:
+      return
+    (state_capacity, num_weights) = swarm.weights.shape
+    table = self.__open((2, state_capacity, 2*num_weights+1))
+    slot  = self.slot
+    table[slot, :, :num_weights]              = swarm.weights
+    table[slot, :, num_weights:2*num_weights] = swarm.momentum
+    table[slot, :, 2*num_weights]             = swarm.energy
+    table.flush()
+    state = {
+      'slot': slot,
+      'position': swarm.position,
+      'rng': swarm.rng.bit_generator.state,
+    }
+    hidden = self.state_path+'.tmp'
+    with open(hidden, 'w') as file:
+      json.dump(state, file)
+    os.replace(hidden, self.state_path)
+    self.slot = 1-slot
+
+  def load(self):
+    with open(self.state_path) as file:
+      state = json.load(file)
+    table = numpy.load(self.table_path, mmap_mode='r+')
+    self.table = table
+    self.slot  = 1-state['slot']
+    num_weights = (table.shape[2]-1)//2
+    row         = table[state['slot']]
+    rng         = numpy.random.default_rng()
+    rng.bit_generator.state = state['rng']
+    return Swarm(
+      numpy.array(row[:, :num_weights]),
+      numpy.array(row[:, num_weights:2*num_weights]),
+      numpy.array(row[:, 2*num_weights]),
+      rng,
+      state['position'],
+    )
+
+class EnergyCache:
+  # LRU map from (digest of a weight vector, id of the samples it was
+  # measured on) to its energy. Entries are only reused for the same
+  # samples, so hits come from particles that did not move while
+  # Optimizer.resample_every keeps the samples fixed. Sample ids come from
+  # `sample_id()`, which never repeats for the life of the cache, so runs
+  # sharing a cache or resuming from a checkpoint cannot match energies
+  # measured on other samples.
+  capacity: int
+  hits: int
+  misses: int
+  draws: int
+
+  def __init__(self, capacity=65536):
+    self.capacity = capacity
+    self.entries  = collections.OrderedDict()
+    self.hits     = 0
+    self.misses   = 0
+    self.draws    = 0
+
+  def __len__(self):
+    return len(self.entries)
+
+  @staticmethod
+  def key(weights, sample_id):
+    weights = numpy.ascontiguousarray(weights)
+    digest  = hashlib.blake2b(weights.view(numpy.uint8), digest_size=16).digest()
+    return (digest, sample_id)
+
+  def sample_id(self):
+    self.draws += 1
+    return self.draws
+
+  def get(self, key):
+    if key in self.entries:
+      self.entries.move_to_end(key)
+      self.hits += 1
+      return self.entries[key]
+    self.misses += 1
+    return None
+
+  def put(self, key, energy):
+    self.entries[key] = energy
+    self.entries.move_to_end(key)
+    while len(self.entries) > self.capacity:
+      self.entries.popitem(last=False)
+
+  def clear(self):
+    self.entries.clear()
+    self.hits   = 0
+    self.misses = 0
 
 @dataclasses.dataclass(frozen=True)
 class Optimizer:
@@ -182,6 +667,17 @@ class Optimizer:
   residual_factor: float
   weight_decay: float
   learning_rate: float
+  coherence: float = 1.0
+  noise_factor: float = 1.0
+  resample_every: int = 1
+  adaptive_confidence: Optional[float] = None
+  min_measurements: int = 2
+
+  def __post_init__(self):
+    if self.min_measurements < 1:
+      raise ValueError(f'Optimizer: min_measurements must be at least 1, got {self.min_measurements}')
+    if self.adaptive_confidence is not None and self.adaptive_confidence < 0:
+      raise ValueError(f'Optimizer: adaptive_confidence must be non-negative, got {self.adaptive_confidence}')
 
   def measure(self, machine, data):
     energy = 0
@@ -190,44 +686,190 @@ class Optimizer:
       energy       += eval(machine(init))
     return energy/self.num_measurements
 
-  def update(self, weights, gradient, momentum):
-    next_momentum = self.interpolate(
-      gradient,
-      momentum,
-      self.momentum_factor,
-    )
-    residual = self.interpolate(
-      gradient,
-      momentum,
-      self.residual_factor,
-    )
-    mixture       = weights*self.weight_decay+sign(residual)
-    weight_update = mixture*self.learning_rate
-    return weight_update, next_momentum
-
-  def __call__(self, initial_weights, constructor, data):
-    weights  = []
-    momentum = []
-    energy   = []
-    for _ in range(self.quota):
-      for i in range(self.state_capacity):
-        machine   = constructor(weights[i])
-        energy[i] = self.measure(machine, data)
-      average_weights  = self.average(weights, energy)
-      average_machine  = constructor(average_weights)
-      energy_threshold = self.measure(average_machine, data)
-      for i in range(self.state_capacity):
-        if energy[i] <= energy_threshold:
-          continue
-        compass  = weights[i]-average_weights
-        sort     = compass*self.coherence
-        search   = (compass@compass)*self.noise()
-        gradient = sort+search
-        weight_update, next_momentum = self.update(
-          weights[i],
-          momentum[i],
-          gradient,
-        )
-        weights[i]  += weight_update
-        momentum[i]  = next_momentum
-    return self.average(weights, energy)
+  def sample(self, data):
+    return [data() for _ in range(self.num_measurements)]
+
+  def measure_batch(self, machines, samples, executor=None, machines_per_task=16):
+    # Every machine is measured on the same `samples` (common random
+    # numbers): differences in energy come from the machines rather than
+    # the draws, and `data()` runs num_measurements times per batch instead
+    # of once per particle. An `eval` wrapped with `batched` scores the
+    # outputs of all machines in a single call.
+    if executor is None:
+      return _measure_machines(machines, samples)
+    tasks = []
+    for start in range(0, len(machines), machines_per_task):
+      chunk = machines[start:start+machines_per_task]
+      tasks.append(executor.submit(_measure_machines, chunk, samples))
+    return numpy.concatenate([task.result() for task in tasks])
+
+  def measure_adaptive(self, machines, samples, reference, executor=None, machines_per_task=16):
+    # Successive halving against `reference`: measure every machine on the
+    # first min_measurements samples, then double the sample count each
+    # round, keeping only the contenders whose confidence interval still
+    # contains the reference. Machines clearly above it (hopeless) or
+    # clearly below it stop early, so the remaining samples go to the ones
+    # near the threshold. Stopped machines keep their estimate over fewer
+    # samples, and `step` compares it against the new threshold like any
+    # other energy. Returns the energies and the number of samples each
+    # machine used.
+    count   = len(samples)
+    totals  = numpy.zeros(len(machines))
+    squares = numpy.zeros(len(machines))
+    counts  = numpy.zeros(len(machines), dtype=numpy.int64)
+    active  = numpy.arange(len(machines))
+    lhs     = 0
+    rhs     = min(self.min_measurements, count)
+    while len(active) > 0 and lhs < count:
+      chunk = [machines[i] for i in active]
+      if executor is None:
+        moments = [_measure_moments(chunk, samples[lhs:rhs])]
+      else:
+        tasks = []
+        for start in range(0, len(chunk), machines_per_task):
+          tasks.append(executor.submit(_measure_moments, chunk[start:start+machines_per_task], samples[lhs:rhs]))
+        moments = [task.result() for task in tasks]
+      totals[active]  += numpy.concatenate([total for total, _ in moments])
+      squares[active] += numpy.concatenate([square for _, square in moments])
+      counts[active]  += rhs-lhs
+      (lhs, rhs) = (rhs, min(2*rhs, count))
+      mean     = totals[active]/counts[active]
+      variance = numpy.maximum(squares[active]/counts[active]-mean*mean, 0.0)
+      margin   = self.adaptive_confidence*numpy.sqrt(variance/counts[active])
+      active   = active[(mean-margin <= reference) & (reference <= mean+margin)]
+    return totals/counts, counts
+
+  def measure_cached(self, weights, constructor, samples, sample_id, cache, executor=None, reference=None):
+    # Returns the energies and the number of samples saved by adaptive
+    # measurement. Energies from particles that stopped early are not
+    # cached, since they are estimates over fewer samples.
+    if cache is None:
+      machines = [constructor(row) for row in weights]
+      return self.__measure(machines, samples, executor, reference)
+    energy  = numpy.empty(len(weights))
+    saved   = 0
+    keys    = [cache.key(row, sample_id) for row in weights]
+    missing = []
+    for i, key in enumerate(keys):
+      hidden = cache.get(key)
+      if hidden is None:
+        missing.append(i)
+      else:
+        energy[i] = hidden
+    if missing:
+      machines        = [constructor(weights[i]) for i in missing]
+      hidden, counts  = self.__measure_counts(machines, samples, executor, reference)
+      energy[missing] = hidden
+      saved           = len(samples)*len(missing)-counts.sum()
+      for i, local_count in zip(missing, counts):
+        if local_count == len(samples):
+          cache.put(keys[i], energy[i])
+    return energy, saved
+
+  def __measure(self, machines, samples, executor, reference):
+    energy, counts = self.__measure_counts(machines, samples, executor, reference)
+    return energy, len(samples)*len(machines)-counts.sum()
+
+  def __measure_counts(self, machines, samples, executor, reference):
+    if self.adaptive_confidence is None or reference is None or not numpy.isfinite(reference):
+      energy = self.measure_batch(machines, samples, executor)
+      return energy, numpy.full(len(machines), len(samples))
+    return self.measure_adaptive(machines, samples, reference, executor)
+
+  def interpolate(self, lhs, rhs, factor, out=None):
+    # factor*rhs+(1-factor)*lhs, written so that `out` may alias `rhs`.
+    out = numpy.subtract(rhs, lhs, out=out)
+    out *= factor
+    out += lhs
+    return out
+
+  def average(self, weights, energy, out=None):
+    # Lower energy is better, so particles are averaged under softmin.
+    probabilities = scipy.special.softmax(-numpy.asarray(energy))
+    return numpy.matmul(probabilities, weights, out=out)
+
+  def step(self, swarm, energy_threshold):
+    # Moves every particle above the threshold against sign(residual) and
+    # its decayed weights, leaving the rest untouched. All temporaries are
+    # the swarm's scratch buffers; `noise` is free once it has been added
+    # to the gradient, so it holds the decay term.
+    numpy.greater(swarm.energy, energy_threshold, out=swarm.active[:, 0])
+    gradient = numpy.subtract(swarm.weights, swarm.average, out=swarm.compass)
+    numpy.einsum('ij,ij->i', gradient, gradient, out=swarm.scale[:, 0])
+    swarm.rng.standard_normal(out=swarm.noise)
+    swarm.scale *= self.noise_factor
+    swarm.noise *= swarm.scale
+    gradient    *= self.coherence
+    gradient    += swarm.noise
+    residual = self.interpolate(gradient, swarm.momentum, self.residual_factor, out=swarm.residual)
+    numpy.sign(residual, out=residual)
+    residual += numpy.multiply(swarm.weights, self.weight_decay, out=swarm.noise)
+    residual *= swarm.active
+    residual *= self.learning_rate
+    swarm.weights -= residual
+    next_momentum = self.interpolate(gradient, swarm.momentum, self.momentum_factor, out=swarm.noise)
+    next_momentum -= swarm.momentum
+    next_momentum *= swarm.active
+    swarm.momentum += next_momentum
+
+  def __call__(self, initial_weights, constructor, data, executor=None, seed=None, checkpoint=None, cache=None, log=None):
+    # Machines are built from row views of the swarm and must not be kept
+    # past the iteration, since the rows are updated in place. With a
+    # `checkpoint` that already holds a saved swarm, training resumes from
+    # it instead of `initial_weights`. An EnergyCache `cache` skips
+    # measuring weights already measured on the current samples; with the
+    # default resample_every=1 the samples change every step, so it only
+    # pays off with resample_every > 1, where particles that did not move
+    # since the last draw are not re-measured. With
+    # adaptive_confidence set, particles are measured against the previous
+    # step's threshold and `log` receives the samples saved per step.
+    if checkpoint is not None and checkpoint.exists:
+      swarm = checkpoint.load()
+      if swarm.state_capacity != self.state_capacity:
+        raise ValueError(f'Optimizer: checkpoint has {swarm.state_capacity} particles, expected {self.state_capacity}')
+    else:
+      rng   = numpy.random.default_rng(seed)
+      swarm = Swarm.initial(initial_weights, self.state_capacity, self.noise_factor, rng)
+    samples          = None
+    sample_id        = None
+    energy_threshold = None
+    while swarm.position < self.quota:
+      if samples is None or swarm.position%self.resample_every == 0:
+        samples = self.sample(data)
+        if cache is not None:
+          sample_id = cache.sample_id()
+      swarm.energy[:], saved = self.measure_cached(
+        swarm.weights,
+        constructor,
+        samples,
+        sample_id,
+        cache,
+        executor,
+        energy_threshold,
+      )
+      average_weights  = self.average(swarm.weights, swarm.energy, out=swarm.average)
+      energy_threshold = self.measure_cached(average_weights[None], constructor, samples, sample_id, cache)[0][0]
+      if log is not None:
+        log(f'Optimizer position {swarm.position} threshold {energy_threshold} samples saved {saved}')
+      self.step(swarm, energy_threshold)
+      swarm.position  += 1
+      if checkpoint is not None:
+        checkpoint.save(swarm)
+    return self.average(swarm.weights, swarm.energy)
+
+def _measure_moments(machines, samples):
+  totals  = numpy.zeros(len(machines))
+  squares = numpy.zeros(len(machines))
+  for init, eval in samples:
+    outputs = [machine(init) for machine in machines]
+    if is_batched(eval):
+      energy = numpy.asarray(eval(outputs), dtype=numpy.float64)
+    else:
+      energy = numpy.array([eval(output) for output in outputs], dtype=numpy.float64)
+    totals  += energy
+    squares += energy*energy
+  return totals, squares
+
+def _measure_machines(machines, samples):
+  totals, _ = _measure_moments(machines, samples)
+  return totals/len(samples)
@@ -1,3 +1,4 @@
+import threading
 from typing import Optional
 
 import PIL
@@ -5,6 +6,8 @@ import torch
 import diffusers
 import transformers
 
+from scriptkitty import diffusion
+
 def t5_xxl_8bit():
   encoder = transformers.T5EncoderModel.from_pretrained(
     'stabilityai/stable-diffusion-3-medium-diffusers',
@@ -16,15 +19,23 @@ def t5_xxl_8bit():
 class Model:
   model_name: str
   model: diffusers.DiffusionPipeline
-  rng: torch.Generator
+  lock: threading.Lock
 
   def __init__(
     self,
     cache_dir: Optional[str] = None,
     local_files_only: bool = False,
     use_gpu: bool = True,
+    pipeline: Optional[diffusers.DiffusionPipeline] = None,
+    embedding_cache: Optional[diffusion.EmbeddingCache] = None,
   ):
     self.model_name = 'stabilityai/stable-diffusion-3-medium-diffusers'
+    self.embedding_cache = embedding_cache
+    if pipeline is not None:
+      # e.g. a small randomly initialized pipeline for testing on CPU.
+      self.model = pipeline
+      self.lock  = threading.Lock()
+      return
     self.model = diffusers.StableDiffusion3Pipeline.from_pretrained(
       # 'stabilityai/stable-diffusion-3-medium-diffusers',
       self.model_name,
@@ -50,8 +61,62 @@ class Model:
       # self.model.enable_model_cpu_offload()
 
     # print(f'model.device = {self.model.device}')
-    # self.rng = torch.Generator(self.model.device)
-    self.rng = torch.Generator()
+    # Pipelines keep per-call state (e.g. the scheduler's timesteps), so
+    # calls from different threads take turns.
+    self.lock = threading.Lock()
+
+  def generators(self, random_seed, count):
+    return diffusion.seeded_generators(random_seed, count)
+
+  def queue(self, max_batch_size=4, max_wait=0.05):
+    # Batches calls from many threads; see diffusion.ImageQueue.
+    return diffusion.ImageQueue(self, max_batch_size, max_wait)
+
+  def encode(self, text):
+    # (prompt_embeds, pooled_prompt_embeds) for a single text.
+    (embeds, _, pooled, _) = self.model.encode_prompt(
+      prompt=text,
+      prompt_2=None,
+      prompt_3=None,
+      do_classifier_free_guidance=False,
+    )
+    return embeds, pooled
+
+  def generate(
+    self,
+    text: list[str],
+    cotext: list[str],
+    generators: list[torch.Generator],
+    xsize: int = 1024,
+    ysize: int = 1024,
+    num_inference_steps: int = 50,
+    guidance_scale: float = 3.0,
+  ) -> list[PIL.Image.Image]:
+    # One pipeline call where image i is drawn from `generators[i]`. With an
+    # embedding cache, repeat texts skip the text encoders entirely.
+    assert len(text) == len(cotext) == len(generators)
+    with self.lock:
+      if self.embedding_cache is None:
+        prompts = { 'prompt': text, 'negative_prompt': cotext }
+      else:
+        prompts = diffusion.prompt_embeddings(
+          self.embedding_cache,
+          diffusion.encoder_key(self.model),
+          self.encode,
+          text,
+          cotext,
+          self.model._execution_device,
+        )
+      target = self.model(
+        **prompts,
+        width=xsize,
+        height=ysize,
+        num_inference_steps=num_inference_steps,
+        guidance_scale=guidance_scale,
+        generator=generators,
+      )
+    images = target.images
+    return images
 
   def __call__(
     self,
@@ -61,24 +126,22 @@ class Model:
     ysize: int = 1024,
     num_inference_steps: int = 50,
     guidance_scale: float = 3.0,
-    random_seed: int = 0,
+    random_seed: int | list[int] = 0,
     batch_size: int = 4,
   ) -> list[PIL.Image.Image]:
-    self.rng.manual_seed(random_seed)
+    # Image i uses the seed `random_seed+i`, or `random_seed[i]`.
     if isinstance(text, str):
       text = [text]*batch_size
     if isinstance(cotext, str):
       cotext = [cotext]*batch_size
     assert len(text) == batch_size
     assert len(cotext) == batch_size
-    target = self.model(
-      prompt=text,
-      negative_prompt=cotext,
-      width=xsize,
-      height=ysize,
+    return self.generate(
+      text,
+      cotext,
+      self.generators(random_seed, batch_size),
+      xsize=xsize,
+      ysize=ysize,
       num_inference_steps=num_inference_steps,
       guidance_scale=guidance_scale,
-      generator=self.rng,
     )
-    images = target.images
-    return images